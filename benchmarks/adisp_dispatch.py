@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Measures the overhead per ``yield`` of ``momoko.adisp.CallbackDispatcher``
+compared to the dispatcher of Momoko 0.4.0, which passed every result through
+``IOLoop.add_callback``.
+
+Two kinds of asynchronous functions are used: one that runs its callback on
+the next IOLoop iteration (like a query does) and one that runs its callback
+right away.
+"""
+
+import sys
+import time
+from functools import partial
+
+from tornado.ioloop import IOLoop
+
+from momoko import adisp
+
+
+class LegacyDispatcher(object):
+    """The ``CallbackDispatcher`` of Momoko 0.4.0.
+    """
+    def __init__(self, generator):
+        self.io_loop = IOLoop.instance()
+        self.g = generator
+        try:
+            self.call(next(self.g))
+        except StopIteration:
+            pass
+
+    def _queue_send_result(self, result, single):
+        self.io_loop.add_callback(partial(self._send_result, result, single))
+
+    def _send_result(self, results, single):
+        try:
+            result = results[0] if single else results
+            if isinstance(result, Exception):
+                self.call(self.g.throw(result))
+            else:
+                self.call(self.g.send(result))
+        except StopIteration:
+            pass
+
+    def call(self, callers):
+        single = not hasattr(callers, '__iter__')
+        if single:
+            callers = [callers]
+        self.call_count = len(list(callers))
+        results = [None] * self.call_count
+        if self.call_count == 0:
+            self._queue_send_result(results, single)
+        else:
+            for count, caller in enumerate(callers):
+                if callable(caller):
+                    caller(callback=partial(self.callback, results, count, single))
+
+    def callback(self, results, index, single, arg):
+        self.call_count -= 1
+        results[index] = arg
+        if self.call_count > 0:
+            return
+        self._queue_send_result(results, single)
+
+
+@adisp.async
+def deferred(value, callback):
+    IOLoop.instance().add_callback(partial(callback, value))
+
+
+@adisp.async
+def immediate(value, callback):
+    callback(value)
+
+
+def run(dispatcher, function, yields):
+    """Run a generator that yields `yields` times and return the time it took
+    in seconds.
+    """
+    io_loop = IOLoop.instance()
+    timing = {}
+
+    def generator():
+        started = time.time()
+        for i in range(yields):
+            yield function(i)
+        timing['elapsed'] = time.time() - started
+        io_loop.add_callback(io_loop.stop)
+
+    io_loop.add_callback(partial(dispatcher, generator()))
+    io_loop.start()
+    return timing['elapsed']
+
+
+def main(yields=100000):
+    print('%-10s %-10s %12s' % ('callback', 'dispatcher', 'usec/yield'))
+    for function in (deferred, immediate):
+        for name, dispatcher in (('0.4.0', LegacyDispatcher),
+                                 ('current', adisp.CallbackDispatcher)):
+            elapsed = min(run(dispatcher, function, yields) for i in range(3))
+            print('%-10s %-10s %12.3f' % (function.__name__, name,
+                elapsed / yields * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+"""
+Measures the throughput and latency of the Momoko clients against a local
+PostgreSQL server for a number of pool sizes and concurrency levels and
+writes the results as JSON, so runs can be compared with ``compare.py``.
+
+Every benchmark keeps `concurrency` operations in flight for `duration`
+seconds. An operation is one ``execute``, a ``batch`` or ``chain`` of
+three queries, one ``yield`` of ``AdispClient.execute`` or one query on a
+``BlockingClient`` connection, in which case `concurrency` is the amount of
+threads.
+
+With ``--fake`` the asynchronous benchmarks run against the in-process fake
+backend of ``fakepg.py`` instead, which measures the overhead of Momoko
+itself.
+
+Example::
+
+    python clients.py --database test --pool-sizes 1,4 \\
+        --concurrency 1,16,64 --output before.json
+"""
+
+import sys
+import json
+import time
+import platform
+import threading
+import argparse
+from functools import partial
+
+import psycopg2
+import tornado
+from tornado.ioloop import IOLoop
+
+import momoko
+from fakepg import FakeBackend
+
+
+BENCHMARKS = ('execute', 'batch', 'chain', 'adisp', 'blocking')
+
+
+def percentile(latencies, fraction):
+    """Return the `fraction` percentile of a sorted list of latencies.
+    """
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1,
+        int(round(fraction * (len(latencies) - 1))))]
+
+
+def summary(name, pool_size, concurrency, queries, latencies, errors,
+            elapsed):
+    """Turn the latencies of the operations of a benchmark into a result.
+    """
+    latencies.sort()
+    operations = len(latencies)
+    return {
+        'benchmark': name,
+        'pool_size': pool_size,
+        'concurrency': concurrency,
+        'operations': operations,
+        'errors': errors,
+        'duration': elapsed,
+        'ops_per_sec': operations / elapsed,
+        'queries_per_sec': operations * queries / elapsed,
+        'latency': {
+            'mean': sum(latencies) / operations if operations else None,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        }
+    }
+
+
+class AsyncBenchmark(object):
+    """Keeps `concurrency` operations of an ``AsyncClient`` in flight until
+    the time is up.
+    """
+    queries = 1
+
+    def __init__(self, db, query, concurrency, duration):
+        self.db = db
+        self.query = query
+        self.concurrency = concurrency
+        self.duration = duration
+        self.latencies = []
+        self.errors = 0
+        self._running = 0
+
+    def run(self):
+        io_loop = IOLoop.instance()
+        self._stop_at = time.time() + self.duration
+        started = time.time()
+        for i in range(self.concurrency):
+            self._running += 1
+            io_loop.add_callback(self.worker)
+        io_loop.start()
+        return time.time() - started
+
+    def stopped(self):
+        self._running -= 1
+        if not self._running:
+            IOLoop.instance().stop()
+
+    def worker(self):
+        self._next()
+
+    def _next(self):
+        if time.time() >= self._stop_at:
+            self.stopped()
+            return
+        self.start(partial(self._done, time.time()))
+
+    def _done(self, started, result):
+        if isinstance(result, Exception):
+            self.errors += 1
+        else:
+            self.latencies.append(time.time() - started)
+            self.fetch(result)
+        self._next()
+
+    def start(self, callback):
+        self.db.execute(self.query, callback=callback)
+
+    def fetch(self, cursor):
+        cursor.fetchall()
+
+
+class BatchBenchmark(AsyncBenchmark):
+    queries = 3
+
+    def start(self, callback):
+        self.db.batch(dict(('query%d' % i, self.query)
+            for i in range(self.queries)), callback=callback)
+
+    def fetch(self, cursors):
+        for cursor in cursors.values():
+            cursor.fetchall()
+
+
+class ChainBenchmark(AsyncBenchmark):
+    queries = 3
+
+    def start(self, callback):
+        self.db.chain([self.query] * self.queries, callback=callback)
+
+    def fetch(self, cursors):
+        for cursor in cursors:
+            cursor.fetchall()
+
+
+class AdispBenchmark(AsyncBenchmark):
+
+    @momoko.process
+    def worker(self):
+        while time.time() < self._stop_at:
+            started = time.time()
+            try:
+                cursor = yield self.db.execute(self.query)
+            except Exception:
+                self.errors += 1
+                continue
+            self.latencies.append(time.time() - started)
+            cursor.fetchall()
+        self.stopped()
+
+
+def warm_up(db, pool_size, query):
+    """Open all connections of the pool before the measurement starts.
+    """
+    io_loop = IOLoop.instance()
+    pending = [pool_size]
+
+    def done(cursor):
+        pending[0] -= 1
+        if not pending[0]:
+            io_loop.stop()
+
+    # Bypasses the adisp wrapper of AdispClient
+    for i in range(pool_size):
+        momoko.AsyncClient.execute(db, query, callback=done)
+    io_loop.start()
+
+
+def poll_summary(stats):
+    """Averages per operation of the poll counts of a pool.
+    """
+    queries = float(stats.profiled_queries) or 1.0
+    return {
+        'polls': stats.polls / queries,
+        'flips': stats.poll_flips / queries,
+        'registrations': stats.handler_registrations / queries,
+        'dispatch_time': stats.dispatch_time / queries,
+    }
+
+
+def run_async(name, settings, query, pool_size, concurrency, duration,
+              profile_polls=False):
+    benchmark = {
+        'execute': AsyncBenchmark,
+        'batch': BatchBenchmark,
+        'chain': ChainBenchmark,
+        'adisp': AdispBenchmark,
+    }[name]
+    client = momoko.AdispClient if name == 'adisp' else momoko.AsyncClient
+    db = client(dict(settings, min_conn=pool_size, max_conn=pool_size,
+        cleanup_timeout=0, ioloop=IOLoop.instance(),
+        profile_polls=profile_polls))
+    try:
+        warm_up(db, pool_size, query)
+        benchmark = benchmark(db, query, concurrency, duration)
+        elapsed = benchmark.run()
+    finally:
+        db.close()
+    result = summary(name, pool_size, concurrency, benchmark.queries,
+        benchmark.latencies, benchmark.errors, elapsed)
+    if profile_polls:
+        result['polls'] = poll_summary(db.stats)
+    return result
+
+
+def run_blocking(settings, query, pool_size, concurrency, duration):
+    db = momoko.BlockingClient(dict(settings, min_conn=pool_size,
+        max_conn=pool_size, cleanup_timeout=0))
+    latencies = []
+    errors = [0]
+    stop_at = time.time() + duration
+
+    def worker():
+        while time.time() < stop_at:
+            started = time.time()
+            try:
+                with db.connection as connection:
+                    cursor = connection.cursor()
+                    cursor.execute(query)
+                    cursor.fetchall()
+            except psycopg2.Error:
+                errors[0] += 1
+                continue
+            # list.append is atomic
+            latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    db.close()
+    return summary('blocking', pool_size, concurrency, 1, latencies,
+        errors[0], elapsed)
+
+
+def server_version(settings):
+    connection = psycopg2.connect(**settings)
+    try:
+        return connection.server_version
+    finally:
+        connection.close()
+
+
+def integers(value):
+    return [int(item) for item in value.split(',')]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--benchmarks',
+        help='comma separated list of benchmarks (default: all)')
+    parser.add_argument('--pool-sizes', type=integers, default=[1, 4, 16],
+        help='comma separated list of pool sizes (default: 1,4,16)')
+    parser.add_argument('--concurrency', type=integers, default=[1, 16, 64],
+        help='comma separated list of concurrency levels (default: 1,16,64)')
+    parser.add_argument('--duration', type=float, default=2.0,
+        help='seconds per benchmark (default: 2)')
+    parser.add_argument('--query', default='SELECT 1;')
+    parser.add_argument('--fake', action='store_true',
+        help='use the fake backend instead of PostgreSQL')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds per query of the fake backend (default: 0)')
+    parser.add_argument('--profile-polls', action='store_true',
+        help='count polls and IOLoop handler registrations per query')
+    parser.add_argument('--output', default='-',
+        help='file to write the JSON results to (default: stdout)')
+    options = parser.parse_args(args)
+    if options.benchmarks is None:
+        options.benchmarks = [name for name in BENCHMARKS
+            if not (options.fake and name == 'blocking')]
+    else:
+        options.benchmarks = options.benchmarks.split(',')
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+    if options.fake and 'blocking' in options.benchmarks:
+        parser.error('the fake backend only supports asynchronous benchmarks')
+    return options
+
+
+def main(args):
+    options = parse_args(args)
+    if options.fake:
+        settings = {
+            'database': 'fake',
+            'connection_factory': FakeBackend(latency=options.latency),
+        }
+        backend = 'fake'
+    else:
+        settings = {
+            'host': options.host,
+            'port': options.port,
+            'database': options.database,
+            'user': options.user,
+            'password': options.password,
+        }
+        backend = server_version(settings)
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'versions': {
+            'momoko': momoko.__version__,
+            'python': platform.python_version(),
+            'tornado': tornado.version,
+            'psycopg2': psycopg2.__version__.split()[0],
+            'postgresql': backend,
+        },
+        'options': {
+            'query': options.query,
+            'duration': options.duration,
+            'fake': options.fake,
+            'latency': options.latency,
+            'profile_polls': options.profile_polls,
+        },
+        'results': [],
+    }
+
+    for name in options.benchmarks:
+        for pool_size in options.pool_sizes:
+            for concurrency in options.concurrency:
+                if name == 'blocking':
+                    result = run_blocking(settings, options.query, pool_size,
+                        concurrency, options.duration)
+                else:
+                    result = run_async(name, settings, options.query,
+                        pool_size, concurrency, options.duration,
+                        options.profile_polls)
+                report['results'].append(result)
+                sys.stderr.write('%-8s pool=%-3d concurrency=%-4d '
+                    '%9.1f ops/s  p50=%.3fms  p99=%.3fms\n' % (name,
+                    pool_size, concurrency, result['ops_per_sec'],
+                    (result['latency']['p50'] or 0) * 1000,
+                    (result['latency']['p99'] or 0) * 1000))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output == '-':
+        print(output)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
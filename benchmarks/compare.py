@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+Compares two result files of ``clients.py``, e.g. from before and after a
+change::
+
+    python compare.py before.json after.json
+
+Every line shows the change of the throughput and of the p50 and p99
+latency. Positive throughput and negative latency changes are improvements.
+"""
+
+import sys
+import json
+
+
+def load(filename):
+    with open(filename) as f:
+        report = json.load(f)
+    return dict(((result['benchmark'], result['pool_size'],
+        result['concurrency']), result) for result in report['results'])
+
+
+def change(before, after):
+    if not before or after is None:
+        return '%8s' % '-'
+    return '%+7.1f%%' % ((after - before) / before * 100)
+
+
+def main(before, after):
+    before = load(before)
+    after = load(after)
+    print('%-8s %5s %5s %12s %8s %8s %8s' % ('bench', 'pool', 'conc',
+        'ops/s', 'change', 'p50', 'p99'))
+    for key in sorted(set(before) & set(after)):
+        old, new = before[key], after[key]
+        print('%-8s %5d %5d %12.1f %s %s %s' % (key + (new['ops_per_sec'],
+            change(old['ops_per_sec'], new['ops_per_sec']),
+            change(old['latency']['p50'], new['latency']['p50']),
+            change(old['latency']['p99'], new['latency']['p99']))))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    main(*sys.argv[1:])
@@ -0,0 +1,261 @@
+"""
+An in-process fake of an asynchronous psycopg2 connection, to measure the
+overhead of Momoko without the noise of a real PostgreSQL server.
+
+A ``FakeBackend`` is passed as the ``connection_factory`` of a pool, which
+passes it on to ``psycopg2.connect``::
+
+    db = momoko.AsyncClient({
+        'database': 'fake',
+        'connection_factory': FakeBackend(latency=0.0005,
+            results={'SELECT 1;': [(1,)]}),
+    })
+
+The connections have ``poll``, ``fileno``, ``isexecuting`` and ``cancel``
+like the real ones. Every connection owns a socketpair and every query first
+returns ``POLL_READ``; a byte is written to the socket when the result is
+due, so the IOLoop waits for real fd readiness. Results are due right away or
+after the configured latency, which is timed by a single background thread.
+"""
+
+import heapq
+import socket
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extensions import POLL_OK, POLL_READ
+
+
+class _Clock(threading.Thread):
+    """A daemon thread that wakes up connections at their due time.
+    """
+    def __init__(self):
+        super(_Clock, self).__init__(name='fakepg-clock')
+        self.daemon = True
+        self._lock = threading.Condition()
+        self._queue = []
+
+    def schedule(self, due, connection):
+        with self._lock:
+            heapq.heappush(self._queue, (due, id(connection), connection))
+            self._lock.notify()
+
+    def run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._lock.wait()
+                due, key, connection = self._queue[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self._lock.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+            connection._wake()
+
+
+_clock = None
+_clock_lock = threading.Lock()
+
+
+def _schedule(due, connection):
+    global _clock
+    with _clock_lock:
+        if _clock is None:
+            _clock = _Clock()
+            _clock.start()
+    _clock.schedule(due, connection)
+
+
+class FakeBackend(object):
+    """A connection factory for fake connections.
+
+    :param latency: Time in seconds a query takes. Results are available
+                    right away (in the next IOLoop iteration) by default.
+    :param connect_latency: Time in seconds it takes to connect.
+    :param results: A dictionary with the rows per query, or a callable that
+                    gets the query and the parameters and returns the rows. It
+                    can raise a ``psycopg2.Error``, which is raised by ``poll``
+                    like the error of a real query. ``[(1,)]`` is returned for
+                    other queries.
+    :param columns: The column names of the results. Defaults to ``column0``,
+                    ``column1``, etc.
+    """
+    def __init__(self, latency=0.0, connect_latency=0.0, results=None,
+                 columns=None):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.results = results or {}
+        self.columns = columns
+        self.connections = 0
+        self.queries = 0
+
+    def __call__(self, dsn, *args, **kwargs):
+        self.connections += 1
+        return FakeConnection(self, dsn)
+
+    def rows(self, query, parameters):
+        self.queries += 1
+        if callable(self.results):
+            return list(self.results(query, parameters))
+        return list(self.results.get(query, [(1,)]))
+
+
+class FakeConnection(object):
+    """A fake asynchronous connection. The connection is made as soon as it's
+    polled after `connect_latency`.
+    """
+    encoding = 'UTF8'
+    server_version = 90300
+    status = psycopg2.extensions.STATUS_READY
+
+    def __init__(self, backend, dsn):
+        self.dsn = dsn
+        self.closed = 0
+        self.notices = []
+        self._backend = backend
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._lock = threading.Lock()
+        self._cursor = None
+        self._result = None
+        self._sent = False
+        self._start(backend.connect_latency, None)
+
+    def _start(self, latency, cursor):
+        self._cursor = cursor
+        self._sent = False
+        if latency > 0:
+            _schedule(time.time() + latency, self)
+        else:
+            self._wake()
+
+    def _wake(self):
+        with self._lock:
+            if not self.closed:
+                self._writer.send(b'x')
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def isexecuting(self):
+        return self._cursor is not None
+
+    def poll(self):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if not self._sent:
+            # Like sending the query to the server
+            self._sent = True
+            return POLL_READ
+        try:
+            self._reader.recv(1)
+        except socket.error:
+            return POLL_READ
+
+        cursor, self._cursor = self._cursor, None
+        result, self._result = self._result, None
+        if isinstance(result, Exception):
+            raise result
+        if cursor is not None:
+            cursor._set_result(result)
+        return POLL_OK
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if name is not None or cursor_factory is not None:
+            raise psycopg2.NotSupportedError(
+                'fake connections only have plain cursors')
+        return FakeCursor(self)
+
+    def cancel(self):
+        if self._cursor is not None:
+            self._result = psycopg2.extensions.QueryCanceledError(
+                'canceling statement due to user request')
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = 1
+            self._reader.close()
+            self._writer.close()
+
+    def _execute(self, cursor, query, parameters):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if self._cursor is not None:
+            raise psycopg2.ProgrammingError('execute cannot be used while '
+                'an asynchronous query is underway')
+        try:
+            self._result = self._backend.rows(query, parameters)
+        except psycopg2.Error as error:
+            self._result = error
+        self._start(self._backend.latency, cursor)
+
+
+class FakeCursor(object):
+    """A fake cursor. The rows are available when the connection returns
+    ``POLL_OK``.
+    """
+    arraysize = 1
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.closed = False
+        self.description = None
+        self.rowcount = -1
+        self.rownumber = 0
+        self._rows = []
+
+    def execute(self, query, parameters=None):
+        self.connection._execute(self, query, parameters)
+
+    def callproc(self, procname, parameters=None):
+        self.connection._execute(self, procname, parameters)
+        return parameters
+
+    def mogrify(self, query, parameters=None):
+        if parameters is None:
+            return query
+        return query % tuple(psycopg2.extensions.adapt(value).getquoted()
+            .decode('ascii') for value in parameters)
+
+    def _set_result(self, rows):
+        self._rows = rows
+        self.rowcount = len(rows)
+        self.rownumber = 0
+        width = len(rows[0]) if rows else 0
+        names = self.connection._backend.columns or [
+            'column%d' % i for i in range(width)]
+        self.description = [(name, None, None, None, None, None, None)
+            for name in names]
+
+    def fetchone(self):
+        if self.rownumber >= len(self._rows):
+            return None
+        self.rownumber += 1
+        return self._rows[self.rownumber - 1]
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        rows = self._rows[self.rownumber:self.rownumber + size]
+        self.rownumber += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self.rownumber:]
+        self.rownumber = len(self._rows)
+        return rows
+
+    def scroll(self, value, mode='relative'):
+        self.rownumber = value if mode == 'absolute' else self.rownumber + value
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        return iter(self.fetchall())
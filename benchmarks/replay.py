@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Replays a workload that was recorded with ``momoko.recorder.Recorder``
+against a database and writes the result as JSON. The operations start at
+the recorded times, so the load has the same shape as in production.
+
+Example::
+
+    python replay.py app.workload --database staging --speed 2 \\
+        --max-conn 8 --output after.json
+"""
+
+import sys
+import json
+import argparse
+
+from tornado.ioloop import IOLoop
+
+import momoko
+from momoko.recorder import Replayer
+from fakepg import FakeBackend
+from clients import percentile
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('workload', help='file with a recording')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='how much faster than recorded to replay (default: 1)')
+    parser.add_argument('--max-conn', type=int, default=20,
+        help='size of the pool (default: 20)')
+    parser.add_argument('--fake', action='store_true',
+        help='use the fake backend instead of PostgreSQL')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds per query of the fake backend (default: 0)')
+    parser.add_argument('--output', default='-',
+        help='file to write the JSON result to (default: stdout)')
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = parse_args(args)
+    if options.fake:
+        settings = {
+            'database': 'fake',
+            'connection_factory': FakeBackend(latency=options.latency),
+        }
+    else:
+        settings = {
+            'host': options.host,
+            'port': options.port,
+            'database': options.database,
+            'user': options.user,
+            'password': options.password,
+        }
+    io_loop = IOLoop.instance()
+    db = momoko.AsyncClient(dict(settings, max_conn=options.max_conn,
+        cleanup_timeout=0, ioloop=io_loop))
+    result = {}
+
+    def done(replay):
+        result.update(replay)
+        io_loop.stop()
+
+    Replayer(db, options.workload, options.speed, done, io_loop).start()
+    io_loop.start()
+    db.close()
+
+    latencies = sorted(result.pop('latencies'))
+    result.update({
+        'workload': options.workload,
+        'speed': options.speed,
+        'max_conn': options.max_conn,
+        'ops_per_sec': result['operations'] / result['elapsed'],
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        }
+    })
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output == '-':
+        print(output)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,6 +15,56 @@ __version__ = '0.4.0'
 __license__ = 'MIT'
 
 
-from .clients import BlockingClient, AsyncClient, AdispClient
-from .pools import BlockingPool, AsyncPool, PoolError
-from .adisp import process, async
+import sys
+import pkgutil
+from types import ModuleType
+from importlib import import_module
+
+
+# The public API and the modules it's imported from. The modules, and with
+# them Tornado and Psycopg, are only imported when an attribute is used for
+# the first time, which keeps "import momoko" cheap for command line tools and
+# processes that fork workers.
+_exports = {
+    'clients': ('BlockingClient', 'ThreadedClient', 'AsyncClient',
+                'AdispClient'),
+    'pools': ('BlockingPool', 'AsyncPool', 'ShardedPool', 'PoolStats',
+              'PoolError', 'PoolOverloadError'),
+    'utils': ('DeadlineExceeded',),
+    'adisp': ('process', 'async'),
+}
+_origins = dict((name, module) for module, names in _exports.items()
+    for name in names)
+
+
+class _LazyModule(ModuleType):
+    """The ``momoko`` package, which imports its attributes on first use.
+    """
+    def __getattr__(self, name):
+        module = _origins.get(name)
+        if module is not None:
+            value = getattr(import_module('.' + module, self.__name__), name)
+        elif not name.startswith('_') and name in set(module_name
+                for loader, module_name, is_package
+                in pkgutil.iter_modules(self.__path__)):
+            # Submodules, e.g. momoko.utils, are imported on first use too
+            value = import_module('.' + name, self.__name__)
+        else:
+            raise AttributeError('module %r has no attribute %r' % (
+                self.__name__, name))
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__all__) | set(self.__dict__))
+
+
+# Replace this module by a lazy one, which only gets the dunder names so the
+# helpers above don't show up in dir(momoko). The old module is kept alive,
+# otherwise Python 2 clears its globals when it's garbage collected.
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(dict((key, value)
+    for key, value in globals().items() if key.startswith('__')))
+_module.__all__ = sorted(_origins)
+_LazyModule._original = sys.modules[__name__]
+sys.modules[__name__] = _module
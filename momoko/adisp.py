@@ -89,50 +89,115 @@ get all their result for processing at once:
 After *all* the asynchronous calls will complete `responses` will be a list of
 responses corresponding to given urls.
 '''
+import logging
 from functools import partial, wraps
-from tornado.ioloop import IOLoop
+
 
 class CallbackDispatcher(object):
+    """Drives a generator that yields asynchronous callers.
+
+    The generator is resumed directly from the callback of the last caller, so
+    no extra IOLoop iteration is needed per ``yield``. Callbacks that fire
+    while the dispatcher is still calling the callers (synchronous callbacks)
+    don't recurse into the generator; the result is picked up by the loop in
+    `_run` instead.
+
+    An exception that a caller raises right away is thrown into the
+    generator at the ``yield``. An exception from the generator is raised to
+    the caller of the process function when it's started, and logged when
+    it's resumed by a callback, so it doesn't unwind into the code that
+    called the callback.
+    """
+    __slots__ = ('g', 'call_count', 'results', '_running', '_has_value',
+        '_value', '_calls')
+
     def __init__(self, generator):
-        self.io_loop = IOLoop.instance()
         self.g = generator
+        self.call_count = 0
+        self._calls = 0
+        self.results = None
+        self._running = False
+        self._has_value = False
+        self._value = None
+        self._run(None, True)
+
+    def _run(self, value, starting=False):
+        self._running = True
         try:
-            self.call(next(self.g))
-        except StopIteration:
-            pass
-
-    def _queue_send_result(self, result, single):
-        self.io_loop.add_callback(partial(self._send_result, result, single))
-
-    def _send_result(self, results, single):
-        try:
-            result = results[0] if single else results
-            if isinstance(result, Exception):
-                self.call(self.g.throw(result))
-            else:
-                self.call(self.g.send(result))
-        except StopIteration:
-            pass
+            while True:
+                try:
+                    if isinstance(value, Exception):
+                        callers = self.g.throw(value)
+                    else:
+                        callers = self.g.send(value)
+                except StopIteration:
+                    return
+                self._has_value = False
+                try:
+                    self.call(callers)
+                except Exception as error:
+                    # E.g. a PoolOverloadError of a query that couldn't be
+                    # queued. The callbacks of the other callers are ignored.
+                    self._calls += 1
+                    self._has_value = False
+                    self._value = None
+                    value = error
+                    continue
+                if not self._has_value:
+                    # Resumed by a callback later on
+                    return
+                value = self._value
+                self._value = None
+        except Exception:
+            if starting:
+                raise
+            logging.exception('Exception in %s',
+                getattr(self.g, '__name__', self.g))
+        finally:
+            self._running = False
+
+    def _resume(self, value):
+        if self._running:
+            self._has_value = True
+            self._value = value
+        else:
+            self._run(value)
 
     def call(self, callers):
-        single = not hasattr(callers, '__iter__')
-        if single:
-            callers = [callers]
-        self.call_count = len(list(callers))
-        results = [None] * self.call_count
+        self._calls += 1
+        if not hasattr(callers, '__iter__'):
+            if callable(callers):
+                callers(callback=partial(self._single_callback, self._calls))
+            return
+
+        if not isinstance(callers, (list, tuple)):
+            callers = list(callers)
+        self.call_count = len(callers)
+        self.results = [None] * self.call_count
         if self.call_count == 0:
-            self._queue_send_result(results, single)
+            self._resume_results()
         else:
-            for count, caller in enumerate(callers):
+            for index, caller in enumerate(callers):
                 if callable(caller):
-                    caller(callback=partial(self.callback, results, count, single))
+                    caller(callback=partial(self.callback, self._calls,
+                        index))
+
+    def _single_callback(self, calls, arg):
+        if calls == self._calls:
+            self._resume(arg)
 
-    def callback(self, results, index, single, arg):
+    def callback(self, calls, index, arg):
+        if calls != self._calls:
+            return
         self.call_count -= 1
-        results[index] = arg
+        self.results[index] = arg
         if self.call_count > 0:
             return
-        self._queue_send_result(results, single)
+        self._resume_results()
+
+    def _resume_results(self):
+        results, self.results = self.results, None
+        self._resume(results)
 
 def process(func):
     @wraps(func)
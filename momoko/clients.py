@@ -10,12 +10,21 @@
 """
 
 
+import time
 import functools
 from contextlib import contextmanager
 
-from .pools import AsyncPool, BlockingPool
-from .adisp import async, process
-from .utils import BatchQuery, QueryChain
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+from .pools import AsyncPool, BlockingPool, ShardedPool
+from .adisp import async
+from .utils import BatchQuery, QueryChain, QueryGraph, QueryPipeline, \
+    FetchedCursor, Future
+from .loops import adapt, current_ioloop
+from .streams import BlobStream, CHUNK_SIZE
 
 
 class BlockingClient(object):
@@ -46,7 +55,163 @@ class BlockingClient(object):
             raise
         else:
             conn.commit()
+        finally:
+            self._pool.put_connection(conn)
+
+    def warmup(self, count=None):
+        """Open connections in parallel until the pool has `count` (defaults to
+        ``min_conn``) connections. See ``BlockingPool.warmup``.
+        """
+        return self._pool.warmup(count)
+
+    def close(self):
+        """Close all connections in the connection pool.
+        """
+        self._pool.close()
+
+    @property
+    def stats(self):
+        """The ``PoolStats`` of the connection pool.
+        """
+        return self._pool.stats
+
+
+class ThreadedClient(object):
+    """The ``ThreadedClient`` class runs ``BlockingClient`` operations on a
+    bounded thread pool and hands the results back to the IOLoop. Use it for
+    CPU-heavy queries (huge results, custom typecasters) that would otherwise
+    block the IOLoop.
+
+    All functions return a Future and accept an optional callback that is
+    executed on the IOLoop once the operation is done. If the operation fails
+    the exception is set on the Future and passed on to the callback.
+
+    To get combined statistics for an ``AsyncClient`` and a ``ThreadedClient``
+    pass the same ``PoolStats`` instance as ``stats`` in both settings.
+
+    **Note:** On Python 2 the futures_ package needs to be installed.
+
+    .. _futures: http://pypi.python.org/pypi/futures
+
+    :param settings: A dictionary that is passed to the ``BlockingPool``
+                     object. The ``ioloop`` and ``max_workers`` keys are used
+                     by the client itself. ``max_workers`` defaults to
+                     ``max_conn``, so worker threads never wait for a
+                     connection.
+    """
+    def __init__(self, settings):
+        if ThreadPoolExecutor is None:
+            raise ImportError('ThreadedClient requires concurrent.futures')
+        settings = dict(settings)
+        self._ioloop = adapt(settings.pop('ioloop', None)) or current_ioloop()
+        max_workers = settings.pop('max_workers', None)
+        self._client = BlockingClient(settings)
+        self._executor = ThreadPoolExecutor(
+            max_workers or self._client._pool.max_conn)
+
+    @property
+    def stats(self):
+        """The ``PoolStats`` of the connection pool.
+        """
+        return self._client.stats
+
+    def run(self, function, *args, **kwargs):
+        """Run ``function(connection, *args)`` on a worker thread.
+
+        The changes are committed when the function returns, or rolled back if
+        it raises an exception. The return value becomes the result of the
+        Future. The connection goes back to the pool when the function
+        returns, so it shouldn't return a cursor, but the rows.
+
+        :param function: A callable that accepts a connection as its first
+                         argument.
+        :param callback: A callable that is executed on the IOLoop with the
+                         result. Optional.
+        """
+        callback = kwargs.pop('callback', None)
+        future = Future()
+        work = self._executor.submit(self._run, function, args)
+        work.add_done_callback(lambda work: self._ioloop.add_callback(
+            functools.partial(self._resolve, future, work, callback)))
+        return future
+
+    def execute(self, operation, parameters=(), callback=None, args={}):
+        """Prepare and execute a database operation (query or command) on a
+        worker thread.
+
+        Same as ``AsyncClient.execute``, but the rows are fetched on the
+        worker thread and a ``momoko.utils.FetchedCursor`` is passed to the
+        callback and returned through the Future.
+
+        :param operation: The database operation (an SQL query or command).
+        :param parameters: A tuple, list or dictionary with parameters. This is
+                           an empty tuple by default.
+        :param callback: A callable that is executed once the operation is
+                         finished. Optional.
+        """
+        return self.run(self._cursor_call, 'execute', (operation, parameters),
+            args, callback=callback)
 
+    def callproc(self, procname, parameters=None, callback=None, args={}):
+        """Call a stored database procedure with the given name on a worker
+        thread.
+
+        Same as ``AsyncClient.callproc``, but the rows are fetched on the
+        worker thread and a ``momoko.utils.FetchedCursor`` is passed to the
+        callback and returned through the Future.
+
+        :param procname: The name of the procedure.
+        :param parameters: A sequence with parameters. This is ``None`` by default.
+        :param callback: A callable that is executed once the procedure is
+                         finished. Optional.
+        """
+        return self.run(self._cursor_call, 'callproc', (procname, parameters),
+            args, callback=callback)
+
+    def warmup(self, count=None, callback=None):
+        """Open connections in parallel on a worker thread until the pool has
+        `count` (defaults to ``min_conn``) connections. The Future gets the
+        amount of connections in the pool.
+        """
+        future = Future()
+        work = self._executor.submit(self._client.warmup, count)
+        work.add_done_callback(lambda work: self._ioloop.add_callback(
+            functools.partial(self._resolve, future, work, callback)))
+        return future
+
+    def close(self):
+        """Wait for running operations and close all connections in the
+        connection pool.
+        """
+        self._executor.shutdown()
+        self._client.close()
+
+    @staticmethod
+    def _cursor_call(connection, function, func_args, cursor_args):
+        cursor = connection.cursor(**cursor_args)
+        try:
+            getattr(cursor, function)(*func_args)
+            return FetchedCursor(cursor)
+        finally:
+            cursor.close()
+
+    def _run(self, function, args):
+        started = time.time()
+        with self._client.connection as conn:
+            result = function(conn, *args)
+        self.stats.query_done(time.time() - started)
+        return result
+
+    def _resolve(self, future, work, callback):
+        error = work.exception()
+        if error is not None:
+            future.set_exception(error)
+            result = error
+        else:
+            result = work.result()
+            future.set_result(result)
+        if callback:
+            callback(result)
 
 
 class AsyncClient(object):
@@ -54,12 +219,21 @@ class AsyncClient(object):
      and ``QueryChain``. It also provides the ``execute`` and ``callproc``
      functions.
 
+    With ``per_loop`` in the settings, the client can be shared by several
+    IOLoops in separate threads. Every IOLoop gets its own ``AsyncPool`` with
+    the other settings, see ``ShardedPool``.
+
     :param settings: A dictionary that is passed to the ``AsyncPool`` object.
     """
     def __init__(self, settings):
-        self._pool = AsyncPool(**settings)
+        settings = dict(settings)
+        if settings.pop('per_loop', False):
+            self._pool = ShardedPool(**settings)
+        else:
+            self._pool = AsyncPool(**settings)
 
-    def batch(self, queries, callback=None):
+    def batch(self, queries, callback=None, priority=None, deadline=None,
+              session=None):
         """Run a batch of queries all at once.
 
         **Note:** Every query needs a free connection. So if three queries are
@@ -80,12 +254,23 @@ class AsyncClient(object):
         :param queries: A dictionary with all the queries.
         :param callback: The function that needs to be executed once all the
                          queries are finished. Optional.
+        :param priority: The priority lane of the queries. Optional.
+        :param deadline: The time (as returned by ``time.time()``) at which all
+                         queries must be finished. Every query gets a
+                         ``statement_timeout`` of the time that's left. If the
+                         deadline passes, the running queries are cancelled
+                         and ``DeadlineExceeded`` is passed to the callback.
+                         Optional.
+        :param session: A dictionary with run-time settings for the
+                        session of the connections, e.g. a ``search_path``.
+                        Optional.
         :return: A dictionary with the same keys as the given queries with the
                  resulting cursors as values.
         """
-        return BatchQuery(self, queries, callback)
+        return BatchQuery(self, queries, callback, priority, deadline, session)
 
-    def chain(self, queries, callback=None):
+    def chain(self, queries, callback=None, priority=None, deadline=None,
+              session=None):
         """Run a chain of queries in the given order.
 
         A list/tuple with queries looks like this::
@@ -102,11 +287,123 @@ class AsyncClient(object):
         :param queries: A tuple or list with all the queries.
         :param callback: The function that needs to be executed once all the
                          queries are finished. Optional.
+        :param priority: The priority lane of the queries. Optional.
+        :param deadline: The time (as returned by ``time.time()``) at which all
+                         queries must be finished. Every query gets a
+                         ``statement_timeout`` of the time that's left. If the
+                         deadline passes, the running queries are cancelled
+                         and ``DeadlineExceeded`` is passed to the callback.
+                         Optional.
+        :param session: A dictionary with run-time settings for the
+                        session of the connections, e.g. a ``search_path``.
+                        Optional.
         :return: A list with the resulting cursors.
         """
-        return QueryChain(self, queries, callback)
+        return QueryChain(self, queries, callback, priority, deadline, session)
 
-    def execute(self, operation, parameters=(), callback=None, args={}):
+    def graph(self, queries, callback=None, concurrency=None, priority=None,
+              deadline=None, session=None):
+        """Run queries that depend on each other as soon as their dependencies
+        are finished.
+
+        A query with dependencies is a dictionary with a ``depends`` list and
+        a ``query``, which can be a callable that computes the query from the
+        cursors of the dependencies::
+
+            {
+                'user': ['SELECT id FROM users WHERE name = %s;', ('frank',)],
+                'posts': {
+                    'depends': ('user',),
+                    'query': lambda results: [
+                        'SELECT title FROM posts WHERE user_id = %s;',
+                        (results['user'].fetchone()[0],)]
+                }
+            }
+
+        See ``momoko.utils.QueryGraph`` for details.
+
+        :param queries: A dictionary with all the queries.
+        :param callback: The function that needs to be executed once all the
+                         queries are finished. Optional.
+        :param concurrency: The maximum amount of queries that run at the same
+                            time. Unlimited by default.
+        :param priority: The priority lane of the queries. Optional.
+        :param deadline: The time (as returned by ``time.time()``) at which all
+                         queries must be finished. Every query gets a
+                         ``statement_timeout`` of the time that's left. If the
+                         deadline passes, the running queries are cancelled
+                         and ``DeadlineExceeded`` is passed to the callback.
+                         Optional.
+        :param session: A dictionary with run-time settings for the
+                        session of the connections, e.g. a ``search_path``.
+                        Optional.
+        :return: A dictionary with the same keys as the given queries with the
+                 resulting cursors as values.
+        """
+        return QueryGraph(self, queries, callback, concurrency, priority,
+            deadline, session)
+
+    def pipeline(self, queries, callback=None, priority=None, deadline=None,
+                 session=None):
+        """Run several independent queries on one connection in one round
+        trip.
+
+        The queries are combined into a single statement, see
+        ``momoko.utils.QueryPipeline`` for the restrictions that come with
+        that. They are given as a list/tuple or as a dictionary::
+
+            {
+                'query1': ['SELECT 42, 12, %s, %s;', (23, 56)],
+                'query2': 'SELECT 1, 2, 3, 4, 5;'
+            }
+
+        :param queries: A list/tuple or a dictionary with all the queries.
+        :param callback: The function that needs to be executed once all the
+                         queries are finished. Optional.
+        :param priority: The priority lane of the queries. Optional.
+        :param deadline: The time (as returned by ``time.time()``) at which the
+                         pipeline is cancelled and ``DeadlineExceeded`` is
+                         passed to the callback. Optional.
+        :param session: A dictionary with run-time settings for the
+                        session of the connections, e.g. a ``search_path``.
+                        Optional.
+        :return: A list or dictionary with a ``PipelineResult`` per query.
+        """
+        return QueryPipeline(self, queries, callback, priority, deadline,
+            session)
+
+    def stream_blob(self, source, parameters=None, callback=None, buffer=None,
+                    write=None, chunk_size=CHUNK_SIZE, priority=None,
+                    deadline=None, session=None):
+        """Read a large object or a large ``bytea`` value in chunks into a
+        buffer or to a function, e.g. a Tornado response. See
+        ``momoko.streams.BlobStream`` for the details.
+
+        :param source: The OID of a large object or a query that selects a
+                       ``bytea`` slice with the placeholders ``%(offset)s``
+                       and ``%(length)s``.
+        :param parameters: A dictionary with the other parameters of the
+                           query. Optional.
+        :param callback: The function that's called with the amount of bytes
+                         that are read, or with an exception. Optional.
+        :param buffer: A writable buffer to read the value into. Optional.
+        :param write: A function that gets a ``memoryview`` of every chunk and
+                      a function to call when it's ready for the next one.
+                      Optional.
+        :param chunk_size: The amount of bytes that's read per query.
+        :param priority: The priority lane of the queries. Optional.
+        :param deadline: The time (as returned by ``time.time()``) at which the
+                         whole value must be read. Optional.
+        :param session: A dictionary with run-time settings for the
+                        session of the connections, e.g. a ``search_path``.
+                        Optional.
+        :return: A ``momoko.streams.BlobStream`` instance.
+        """
+        return BlobStream(self, source, callback, parameters, buffer, write,
+            chunk_size, priority, deadline, session)
+
+    def execute(self, operation, parameters=(), callback=None, args={},
+                decoder=None, priority=None, deadline=None, session=None):
         """Prepare and execute a database operation (query or command).
 
         Parameters may be provided as sequence or mapping and will be bound to
@@ -121,10 +418,38 @@ class AsyncClient(object):
                            an empty tuple by default.
         :param callback: A callable that is executed once the operation is
                          finished. Optional.
+        :param decoder: A ``momoko.results.ProcessDecoder``. If provided the
+                        rows are decoded on a process pool and the callback
+                        receives the decoded rows instead of a cursor. The
+                        decoder's cursor factory is used. Optional.
+        :param priority: The priority lane of the query. Defaults to the
+                         ``default_lane`` of the pool.
+        :param deadline: The time (as returned by ``time.time()``) at which the
+                         query must be finished. The ``statement_timeout`` of
+                         the query is set to the time that's left when it's
+                         sent. If the deadline passes, the query is cancelled
+                         and ``DeadlineExceeded`` is passed to the callback.
+                         Optional.
+        :param session: A dictionary with run-time settings for the session
+                        of the connection, e.g.
+                        ``{'search_path': 'tenant, public'}``. The pool prefers
+                        a connection that already has these settings and
+                        resets the settings of earlier operations that aren't
+                        in it. Don't change session settings with ``SET`` in
+                        the query itself, the pool doesn't notice them and
+                        they stay on the connection. Optional.
+        :return: A ``momoko.pools.Operation`` that can be used to cancel the
+                 query.
         """
-        self._pool.new_cursor('execute', (operation, parameters), callback, cursor_args=args)
-
-    def callproc(self, procname, parameters=None, callback=None, args={}):
+        if decoder is not None:
+            args = dict(args, cursor_factory=decoder.cursor_factory)
+            callback = functools.partial(decoder.decode, callback=callback)
+        return self._pool.new_cursor('execute', (operation, parameters), callback,
+            cursor_args=args, priority=priority, deadline=deadline,
+            session=session)
+
+    def callproc(self, procname, parameters=None, callback=None, args={},
+                 priority=None, deadline=None, session=None):
         """Call a stored database procedure with the given name.
 
         The sequence of parameters must contain one entry for each argument that
@@ -139,14 +464,50 @@ class AsyncClient(object):
         :param parameters: A sequence with parameters. This is ``None`` by default.
         :param callback: A callable that is executed once the procedure is
                          finished. Optional.
+        :param priority: The priority lane of the procedure call. Defaults to
+                         the ``default_lane`` of the pool.
+        :param deadline: The time (as returned by ``time.time()``) at which the
+                         procedure call is cancelled and ``DeadlineExceeded``
+                         is passed to the callback. Optional.
+        :param session: A dictionary with run-time settings for the session
+                        of the connection, e.g. a ``search_path``. Optional.
+        :return: A ``momoko.pools.Operation`` that can be used to cancel the
+                 procedure call.
         """
-        self._pool.new_cursor('callproc', (procname, parameters), callback, cursor_args=args)
+        return self._pool.new_cursor('callproc', (procname, parameters), callback,
+            cursor_args=args, priority=priority, deadline=deadline,
+            session=session)
+
+    def warmup(self, count=None, callback=None):
+        """Open connections in parallel until the pool has `count` (defaults to
+        ``min_conn``) connections. Returns a Future. See ``AsyncPool.warmup``.
+        """
+        return self._pool.warmup(count, callback)
 
     def close(self):
         """Close all connections in the connection pool.
         """
         self._pool.close()
 
+    @property
+    def stats(self):
+        """The ``PoolStats`` of the connection pool.
+        """
+        return self._pool.stats
+
+    @property
+    def queue_depth(self):
+        """The amount of operations that are waiting for a connection.
+        """
+        return self._pool.queue_depth
+
+    @property
+    def expected_wait(self):
+        """The expected time in seconds a new operation has to wait for a
+        connection.
+        """
+        return self._pool.expected_wait
+
     def cursor(self, *args, **kwargs):
         connection = self._pool.get_connection()
         return connection.cursor(*args, **kwargs)
@@ -154,79 +515,19 @@ class AsyncClient(object):
 class AdispClient(AsyncClient):
     """The AdispClient class is a wrapper for ``AsyncPool`` and uses adisp to
     let the developer use the ``execute``, ``callproc``, ``chain`` and ``batch``
-    functions in a blocking style. The ``chain`` and ``batch`` functions are
-    slightly different than the two in ``Client``.
+    functions in a blocking style.
 
     Adisp handles callbacks and therefore the user/developer does not have
-    to provide a callback.
+    to provide a callback. If a query fails, the exception is raised where
+    the result is yielded.
 
     :param settings: A dictionary that is passed to the ``AsyncPool`` object.
     """
 
     execute = async(AsyncClient.execute)
     callproc = async(AsyncClient.callproc)
-
-    @async
-    @process
-    def chain(self, queries, callback):
-        """Run a chain of queries in the given order.
-
-        A list/tuple with queries looks like this::
-
-            (
-                ['SELECT 42, 12, %s, 11;', (23,)],
-                'SELECT 1, 2, 3, 4, 5;'
-            )
-
-        A query with paramaters is contained in a list: ``['some sql
-        here %s, %s', ('and some', 'paramaters here')]``. A query
-        without paramaters doesn't need to be in a list.
-
-        :param queries: A tuple or with all the queries.
-        :param callback: The function that needs to be executed once all the
-                         queries are finished.
-        :return: A list with the resulting cursors.
-        """
-        cursors = []
-        for query in queries:
-            if isinstance(query, str):
-                cursor = yield self.execute(query)
-            else:
-                cursor = yield self.execute(*query)
-            cursors.append(cursor)
-        callback(cursors)
-
-    @async
-    @process
-    def batch(self, queries, callback):
-        """Run a batch of queries all at once.
-
-        **Note:** Every query needs a free connection. So if three queries are
-        are executed, three free connections are used.
-
-        A dictionary with queries looks like this::
-
-            {
-                'query1': ['SELECT 42, 12, %s, %s;', (23, 56)],
-                'query2': 'SELECT 1, 2, 3, 4, 5;',
-                'query3': 'SELECT 465767, 4567, 3454;'
-            }
-
-        A query with paramaters is contained in a list: ``['some sql
-        here %s, %s', ('and some', 'paramaters here')]``. A query
-        without paramaters doesn't need to be in a list.
-
-        :param queries: A dictionary with all the queries.
-        :param callback: The function that needs to be executed once all the
-                         queries are finished.
-        :return: A dictionary with the same keys as the given queries with the
-                 resulting cursors as values.
-        """
-        def _exec_query(query, callback):
-            if isinstance(query[1], str):
-                cursor = yield self.execute(query[1])
-            else:
-                cursor = yield self.execute(*query[1])
-            callback((query[0], cursor))
-        cursors = yield list(map(async(process(_exec_query)), queries.items()))
-        callback(dict(cursors))
+    chain = async(AsyncClient.chain)
+    batch = async(AsyncClient.batch)
+    graph = async(AsyncClient.graph)
+    pipeline = async(AsyncClient.pipeline)
+    stream_blob = async(AsyncClient.stream_blob)
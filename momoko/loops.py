@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.loops
+    ~~~~~~~~~~~~
+
+    The event loops Momoko can run on. Pools and pollers use the part of the
+    interface of Tornado's IOLoop that's listed below, so a Tornado IOLoop is
+    used as is and other loops are wrapped in an adapter.
+
+    - ``add_handler(fd, handler, events)`` and ``remove_handler(fd)``
+    - ``add_callback(callback, *args)``
+    - ``add_timeout(timedelta, callback, *args)`` and
+      ``remove_timeout(timeout)``
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import datetime
+
+try:
+    from tornado.ioloop import IOLoop
+except ImportError:
+    IOLoop = None
+
+try:
+    from tornado.concurrent import Future
+except ImportError:
+    try:
+        from concurrent.futures import Future
+    except ImportError:
+        Future = None
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+# Event masks, the same values as IOLoop.READ and IOLoop.WRITE
+READ = 0x001
+WRITE = 0x004
+
+
+class AsyncioLoop(object):
+    """Runs Momoko on an asyncio event loop, e.g. one of uvloop, without
+    Tornado. The file descriptors of the connections are watched with
+    ``add_reader`` and ``add_writer``::
+
+        loop = asyncio.get_event_loop()
+        pool = momoko.AsyncPool(ioloop=AsyncioLoop(loop), database='app')
+
+    An asyncio loop that's passed as ``ioloop`` is wrapped automatically.
+
+    :param loop: An asyncio event loop. Defaults to the loop of the current
+                 thread.
+    """
+    def __init__(self, loop=None):
+        if asyncio is None:
+            raise ImportError('AsyncioLoop requires asyncio')
+        self.loop = loop or asyncio.get_event_loop()
+        self._handlers = {}
+
+    def add_handler(self, fd, handler, events):
+        self._handlers[fd] = events
+        if events & READ:
+            self.loop.add_reader(fd, handler, fd, READ)
+        if events & WRITE:
+            self.loop.add_writer(fd, handler, fd, WRITE)
+
+    def remove_handler(self, fd):
+        events = self._handlers.pop(fd, 0)
+        if events & READ:
+            self.loop.remove_reader(fd)
+        if events & WRITE:
+            self.loop.remove_writer(fd)
+
+    def add_callback(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def time(self):
+        return self.loop.time()
+
+    def add_timeout(self, deadline, callback, *args):
+        """Call `callback` at `deadline`, a ``time`` value of the loop or a
+        ``datetime.timedelta`` relative to now.
+        """
+        if isinstance(deadline, datetime.timedelta):
+            delay = deadline.total_seconds()
+        else:
+            delay = deadline - self.loop.time()
+        return self.loop.call_later(max(delay, 0), callback, *args)
+
+    def remove_timeout(self, timeout):
+        timeout.cancel()
+
+    def __eq__(self, other):
+        return isinstance(other, AsyncioLoop) and other.loop is self.loop
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.loop)
+
+
+class PeriodicTimer(object):
+    """Calls `callback` every `interval` seconds on `ioloop` between
+    ``start`` and ``stop``. Unlike Tornado's ``PeriodicCallback`` it works on
+    any loop and doesn't depend on the current IOLoop.
+    """
+    def __init__(self, ioloop, callback, interval):
+        self._ioloop = ioloop
+        self._callback = callback
+        self._interval = interval
+        self._timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        self._timeout = self._ioloop.add_timeout(
+            datetime.timedelta(seconds=self._interval), self._run)
+
+    def _run(self):
+        self._schedule()
+        self._callback()
+
+
+def adapt(ioloop):
+    """Return `ioloop` wrapped in an adapter when it isn't a Tornado IOLoop or
+    an adapter already.
+    """
+    if asyncio is not None and isinstance(ioloop, asyncio.AbstractEventLoop):
+        return AsyncioLoop(ioloop)
+    return ioloop
+
+
+def create_future(ioloop):
+    """Return a new Future that can be awaited on `ioloop`, or ``None`` if
+    there are no Futures.
+    """
+    if isinstance(ioloop, AsyncioLoop):
+        return ioloop.loop.create_future()
+    return Future() if Future is not None else None
+
+
+def current_ioloop():
+    """Return the loop of the current thread: Tornado's current IOLoop, which
+    is the global instance on the main thread and on Tornado versions without
+    ``IOLoop.current``, or the asyncio event loop when Tornado isn't
+    installed.
+    """
+    if IOLoop is None:
+        return AsyncioLoop()
+    current = getattr(IOLoop, 'current', None)
+    if current is None:
+        return IOLoop.instance()
+    return current()
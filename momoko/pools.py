@@ -9,28 +9,87 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import os
+import re
+import time
 import logging
+import datetime
 import functools
+import threading
+from collections import deque
 
 import psycopg2
-from psycopg2 import DatabaseError, InterfaceError
-from psycopg2.extensions import STATUS_READY
-from tornado.ioloop import IOLoop, PeriodicCallback
+import psycopg2.extras
+from psycopg2 import DatabaseError, InterfaceError, ProgrammingError
+from psycopg2.extensions import STATUS_READY, QueryCanceledError
 
-from .utils import Poller
+try:
+    from tornado.process import task_id, cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
+
+    def task_id():
+        return None
+
+from .utils import Poller, PollCounts, DeadlineExceeded
+from .loops import IOLoop, PeriodicTimer, adapt, create_future, \
+    current_ioloop
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def fork_share(total, processes, task):
+    """Return the share of worker `task` of `total` connections when they're
+    divided over `processes` workers.
+    """
+    return total // processes + (1 if task < total % processes else 0)
+
+
+def _forget(conn):
+    """Close a connection that was inherited from the parent process without
+    ending its session on the server, which the parent still uses. The socket
+    is replaced by ``/dev/null`` first, so the terminate message that's sent on
+    close goes nowhere.
+    """
+    if conn.closed:
+        return
+    try:
+        null = os.open(os.devnull, os.O_RDWR)
+        try:
+            os.dup2(null, conn.fileno())
+        finally:
+            os.close(null)
+    except (OSError, InterfaceError):
+        pass
+    conn.close()
 
 
 class BlockingPool(object):
-    """A connection pool that manages blocking PostgreSQL connections
-    and cursors.
+    """A thread-safe connection pool that manages blocking PostgreSQL
+    connections and cursors.
+
+    Connections are handed out with ``get_connection`` and must be given back
+    with ``put_connection`` once a thread is done with them. A connection is
+    never handed to two threads at the same time.
 
     :param min_conn: The minimum amount of connections that is created when a
                      connection pool is created.
     :param max_conn: The maximum amount of connections the connection pool can
-                     have. If the amount of connections exceeds the limit a
-                     ``PoolError`` exception is raised.
+                     have. If all connections are in use, ``get_connection``
+                     waits until one is returned to the pool.
     :param cleanup_timeout: Time in seconds between pool cleanups. Connections
                             will be closed until there are ``min_conn`` left.
+                            Cleanups run on a background thread.
+    :param wait_timeout: Time in seconds ``get_connection`` waits for a free
+                         connection before a ``PoolError`` exception is raised.
+                         Waits forever when ``None`` (the default).
+    :param stats: A ``PoolStats`` instance to record statistics in. A new one
+                  is created when it's not provided.
+    :param lazy: Don't open ``min_conn`` connections when the pool is created,
+                 but when ``warmup`` is called or a connection is needed.
     :param host: The database host address (defaults to UNIX socket if not provided)
     :param port: The database host port (defaults to 5432 if not provided)
     :param database: The database name
@@ -41,99 +100,384 @@ class BlockingPool(object):
                                should be a callable object taking a dsn argument.
     """
     def __init__(self, min_conn=1, max_conn=20, cleanup_timeout=10,
-                 *args, **kwargs):
+                 wait_timeout=None, stats=None, lazy=False, *args, **kwargs):
         self.min_conn = min_conn
         self.max_conn = max_conn
+        self.wait_timeout = wait_timeout
+        self.stats = stats or PoolStats()
         self.closed = False
 
         self._args = args
         self._kwargs = kwargs
 
+        self._lock = threading.Condition()
         self._pool = []
+        self._free = []
+        # Connections that were in use when the pool was closed
+        self._closed_in_use = set()
+        self._opening = 0
+        self._pid = os.getpid()
+        self._cleanup_timeout = cleanup_timeout
 
-        for i in range(self.min_conn):
-            self._new_conn()
+        if not lazy:
+            for i in range(self.min_conn):
+                conn = self._new_conn()
+                self._pool.append(conn)
+                self._free.append(conn)
 
-        # Create a periodic callback that tries to close inactive connections
-        if cleanup_timeout > 0:
-            self._cleaner = PeriodicCallback(self._clean_pool,
-                cleanup_timeout * 1000)
+        self._start_cleaner()
+
+    def _start_cleaner(self):
+        # Start a thread that periodically tries to close inactive connections
+        self._cleaner = None
+        if self._cleanup_timeout > 0:
+            self._cleaner = _CleanupThread(self._clean_pool,
+                self._cleanup_timeout)
             self._cleaner.start()
 
+    def _check_fork(self):
+        """Forget the connections that were inherited from the parent process
+        when the pool is used in a forked child for the first time.
+        """
+        if os.getpid() == self._pid:
+            return
+        self._pid = os.getpid()
+        # The lock and the cleanup thread don't survive a fork
+        self._lock = threading.Condition()
+        for conn in self._pool:
+            _forget(conn)
+        self._pool = []
+        self._free = []
+        self._closed_in_use = set()
+        self._opening = 0
+        self.stats.reset()
+        if not self.closed:
+            self._start_cleaner()
+
     def _new_conn(self):
         """Create a new connection.
         """
-        if len(self._pool) > self.max_conn:
-            raise PoolError('connection pool exausted')
         conn = psycopg2.connect(*self._args, **self._kwargs)
-        self._pool.append(conn)
-
+        self.stats.connection_opened()
         return conn
 
-    def _get_free_conn(self):
-        """Look for a free connection and return it.
+    def warmup(self, count=None):
+        """Open connections until the pool has `count` connections. The
+        connections are opened in parallel, one thread per connection, and
+        the function returns the amount of connections in the pool when
+        they're all open. The first error is raised when a connection can't
+        be made.
 
-        `None` is returned when no free connection can be found.
+        :param count: The amount of connections. Defaults to ``min_conn``.
         """
-        if self.closed:
-            raise PoolError('connection pool is closed')
-        for conn in self._pool:
-            if conn.status == STATUS_READY:
-                return conn
-        return None
+        if count is None:
+            count = self.min_conn
+        self._check_fork()
+        with self._lock:
+            if self.closed:
+                raise PoolError('connection pool is closed')
+            missing = max(0, min(count, self.max_conn) - len(self._pool) -
+                self._opening)
+            self._opening += missing
+        errors = []
+
+        def connect():
+            try:
+                conn = self._new_conn()
+            except Exception as error:
+                errors.append(error)
+                conn = None
+            with self._lock:
+                self._opening -= 1
+                if conn is not None:
+                    self._pool.append(conn)
+                    self._free.append(conn)
+                self._lock.notify()
+
+        threads = [threading.Thread(target=connect) for i in range(missing)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return len(self._pool)
 
-    def get_connection(self):
+    def get_connection(self, timeout=None):
         """Get a connection from the pool.
 
-        If there's no free connection available, a new connection will be created.
+        If there's no free connection available, a new connection will be
+        created. When the pool already holds ``max_conn`` connections the
+        calling thread waits until another thread returns one.
+
+        :param timeout: Time in seconds to wait for a free connection. Defaults
+                        to ``wait_timeout``.
         """
-        connection = self._get_free_conn()
-        if not connection:
-            connection = self._new_conn()
+        if timeout is None:
+            timeout = self.wait_timeout
+        self._check_fork()
+        started = time.time()
+        deadline = None if timeout is None else started + timeout
+
+        with self._lock:
+            while True:
+                if self.closed:
+                    raise PoolError('connection pool is closed')
+                if self._free:
+                    self.stats.checked_out(time.time() - started)
+                    return self._free.pop()
+                if len(self._pool) + self._opening < self.max_conn:
+                    self._opening += 1
+                    break
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolError('connection pool exausted')
+                    self._lock.wait(remaining)
 
-        return connection
+        # Connect without holding the lock, the slot is reserved already
+        try:
+            conn = self._new_conn()
+        except:
+            with self._lock:
+                self._opening -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._opening -= 1
+            self._pool.append(conn)
+        self.stats.checked_out(time.time() - started)
+        return conn
+
+    def put_connection(self, conn):
+        """Return a connection to the pool.
+
+        Broken connections are dropped and connections that are still inside
+        a transaction are rolled back before another thread can get them.
+
+        :param conn: A connection that was returned by ``get_connection``.
+        """
+        if not conn.closed and conn.status != STATUS_READY:
+            try:
+                conn.rollback()
+            except (DatabaseError, InterfaceError):
+                pass
+
+        with self._lock:
+            if conn in self._closed_in_use:
+                # Closed by close() already
+                self._closed_in_use.remove(conn)
+                self.stats.checked_in()
+                return
+            if conn not in self._pool:
+                return
+            self.stats.checked_in()
+            if self.closed or conn.closed:
+                self._pool.remove(conn)
+                self.stats.connection_closed()
+                if not conn.closed:
+                    conn.close()
+            else:
+                self._free.append(conn)
+            self._lock.notify()
 
     def _clean_pool(self):
         """Close a number of inactive connections when the number of connections
         in the pool exceeds the number in `min_conn`.
         """
-        if self.closed:
-            raise PoolError('connection pool is closed')
-        if len(self._pool) > self.min_conn:
+        with self._lock:
+            if self.closed:
+                return
             conns = len(self._pool) - self.min_conn
-            for conn in self._pool[:]:
-                if conn.status == STATUS_READY:
-                    conn.close()
-                    conns = conns - 1
-                    self._pool.remove(conn)
-                    if conns == 0:
-                        break
+            if conns <= 0:
+                return
+            # The least recently used connections are at the front
+            inactive = self._free[:conns]
+            del self._free[:len(inactive)]
+            for conn in inactive:
+                self._pool.remove(conn)
+
+        for conn in inactive:
+            conn.close()
+            self.stats.connection_closed()
 
     def close(self):
         """Close all open connections in the pool.
         """
-        if self.closed:
-            raise PoolError('connection pool is closed')
-        for conn in self._pool:
+        with self._lock:
+            if self.closed:
+                raise PoolError('connection pool is closed')
+            self.closed = True
+            self._closed_in_use = set(self._pool) - set(self._free)
+            pool, self._pool, self._free = self._pool, [], []
+            self._lock.notify_all()
+
+        if self._cleaner is not None:
+            self._cleaner.stop()
+        for conn in pool:
             if not conn.closed:
                 conn.close()
-        self._cleaner.stop()
-        self._pool = []
-        self.closed = True
+            self.stats.connection_closed()
+
+
+class _CleanupThread(threading.Thread):
+    """A daemon thread that calls `function` every `interval` seconds until
+    `stop` is called.
+    """
+    def __init__(self, function, interval):
+        super(_CleanupThread, self).__init__(name='momoko-pool-cleaner')
+        self.daemon = True
+        self._function = function
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._function()
+            except Exception:
+                logging.exception('Pool cleanup failed')
+
+    def stop(self):
+        self._stopped.set()
+        if self is not threading.current_thread():
+            self.join()
+
+
+# Default priority lanes: name -> (weight, reserved connections)
+LANES = {
+    'interactive': (4, 0),
+    'normal': (2, 0),
+    'background': (1, 0),
+}
+
+# Names of run-time settings that can be used in a session
+SETTING_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+
+# Names of procedure arguments that are passed by name
+ARGUMENT_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Statements that can't run inside a transaction block, so they can't carry
+# the session settings and statement_timeout of an operation in their query
+NO_TRANSACTION = re.compile(r'^\s*(VACUUM|ALTER\s+SYSTEM|(CREATE|DROP)\s+'
+    r'(DATABASE|TABLESPACE)|(CREATE|DROP|REINDEX)\b[^;]*\bCONCURRENTLY)\b',
+    re.IGNORECASE)
+
+# Number of operations with the most polls that PoolStats keeps
+OUTLIERS = 10
+
+# Functions that register a typecaster on a connection, given the OID and the
+# array OID of the type
+TYPECASTERS = {
+    'hstore': lambda conn, oid, array_oid: psycopg2.extras.register_hstore(
+        conn, oid=oid, array_oid=array_oid),
+    'json': lambda conn, oid, array_oid: psycopg2.extras.register_json(
+        conn, oid=oid, array_oid=array_oid),
+    'jsonb': lambda conn, oid, array_oid: psycopg2.extras.register_json(
+        conn, oid=oid, array_oid=array_oid, name='jsonb'),
+}
 
 
 class AsyncPool(object):
     """A connection pool that manages asynchronous PostgreSQL connections
     and cursors.
 
+    When all connections are in use, operations wait in a queue per priority
+    lane. Free connections are handed out to the lanes by weighted fair
+    scheduling: a lane with weight 4 gets four connections for every one that
+    goes to a waiting lane with weight 1. A lane can reserve a number of
+    connections, which the other lanes can't use.
+
+    Operations can ask for session settings, e.g. a ``search_path``. The pool
+    keeps track of the settings it made on every connection, hands out a
+    connection that already has the right settings when there is one and
+    otherwise changes only the settings that differ. Settings of earlier
+    operations that an operation doesn't ask for are reset to their defaults.
+
+    Only settings that are passed as ``session`` are tracked. A ``SET`` in the
+    SQL of a query isn't noticed and stays on the connection for the next
+    operations, so use ``session``, or ``SET LOCAL``, which only lasts until
+    the end of the transaction of the query. The pool doesn't reset
+    connections with ``RESET ALL`` or ``DISCARD ALL``, because that would also
+    undo the settings of ``on_connect``.
+
+    Behind a pooler in transaction mode, like PgBouncer with ``pool_mode =
+    transaction``, a connection can be served by a different server
+    connection for every transaction, so session state can't be kept. With
+    ``transaction_pooling`` the session settings and ``statement_timeout`` of
+    an operation are set with ``set_config(..., true)`` and ``SET LOCAL`` in
+    the same transaction as its query and aren't tracked per connection, and
+    ``callproc`` operations that need them are run as an ``execute``.
+    ``max_conn`` can be far larger than the amount of server connections of
+    the pooler.
+
+    A pool that's created before Tornado's ``fork_processes`` needs
+    ``processes``. It then doesn't use an IOLoop or open connections until
+    it's used for the first time, in a worker, because Tornado doesn't allow
+    an IOLoop to be used before the fork. Every worker gets a share of
+    ``min_conn`` and ``max_conn``, and ``stagger`` spreads out their warmups.
+    A pool that's used in a forked child drops the connections of the parent,
+    also the ones that are still being opened, without ending their sessions
+    on the server.
+
     :param min_conn: The minimum amount of connections that is created when a
                      connection pool is created.
     :param max_conn: The maximum amount of connections the connection pool can
-                     have. If the amount of connections exceeds the limit a
-                     ``PoolError`` exception is raised.
+                     have. If all connections are in use, operations wait
+                     until a connection is free.
     :param cleanup_timeout: Time in seconds between pool cleanups. Connections
                             will be closed until there are ``min_conn`` left.
-    :param ioloop: An instance of Tornado's IOLoop.
+    :param ioloop: An instance of Tornado's IOLoop or an asyncio event loop.
+    :param stats: A ``PoolStats`` instance to record statistics in. A new one
+                  is created when it's not provided.
+    :param lanes: A dictionary with the priority lanes. The keys are the lane
+                  names and the values ``(weight, reserved)`` tuples. Defaults
+                  to ``LANES``, which has an ``interactive``, ``normal`` and
+                  ``background`` lane.
+    :param default_lane: The lane that is used when no priority is given.
+    :param max_queue: The maximum amount of operations that can wait for a
+                      connection. New operations are rejected with a
+                      ``PoolOverloadError`` when the queue is full. Unlimited
+                      by default.
+    :param max_wait: New operations are rejected with a ``PoolOverloadError``
+                     when the expected wait time for a connection, in seconds,
+                     is longer than this. Unlimited by default.
+    :param on_connect: Setup for new connections. A query or a list of queries
+                       (an SQL string or a ``[sql, parameters]`` list) and/or
+                       callables. A callable gets the connection and a callback
+                       that must be called when it's done, with the exception
+                       if it failed. Connections are only used by operations
+                       once the setup is done.
+    :param typecasters: A list with the names of types, e.g. ``hstore`` or
+                        ``json``, to register typecasters for on every
+                        connection, or ``(name, function)`` tuples for other
+                        types. The function gets the connection, the OID and
+                        the array OID of the type. The OIDs are fetched once,
+                        by the first connection. See ``TYPECASTERS``.
+    :param transaction_pooling: Set this when the pool connects to a pooler in
+                                transaction mode. ``on_connect`` can only have
+                                callables then.
+    :param recorder: A ``momoko.recorder.Recorder`` that records all
+                     operations, so they can be replayed later.
+    :param tracer: A ``momoko.trace.Tracer`` that records the lifecycle of
+                   sampled operations as a timeline.
+    :param profile_polls: Count the polls, state flips and IOLoop handler
+                          registrations of every operation and the time its
+                          callback takes in the pool statistics.
+    :param lazy: Don't open ``min_conn`` connections when the pool is created,
+                 but when ``warmup`` is called or a connection is needed.
+    :param processes: The amount of worker processes started with Tornado's
+                      ``fork_processes`` (0 for one per CPU). ``min_conn`` and
+                      ``max_conn`` are then the budget of all workers
+                      together, and every worker gets its share. The pool
+                      starts when it's first used; call ``warmup`` in the
+                      worker to open the connections right away.
+    :param stagger: Time in seconds between the warmups of the workers, so
+                    they don't all connect at once. Worker ``n`` opens its
+                    ``min_conn`` connections after ``n * stagger`` seconds.
     :param host: The database host address (defaults to UNIX socket if not provided)
     :param port: The database host port (defaults to 5432 if not provided)
     :param database: The database name
@@ -144,138 +488,1117 @@ class AsyncPool(object):
                                should be a callable object taking a dsn argument.
     """
     def __init__(self, min_conn=1, max_conn=20, cleanup_timeout=10,
-                 ioloop=None, *args, **kwargs):
+                 ioloop=None, stats=None, lanes=None, default_lane='normal',
+                 max_queue=None, max_wait=None, on_connect=None,
+                 typecasters=None, transaction_pooling=False, recorder=None,
+                 tracer=None, profile_polls=False, lazy=False, processes=None,
+                 stagger=0.0, *args, **kwargs):
         self.min_conn = min_conn
         self.max_conn = max_conn
+        self.processes = processes
+        self.stagger = stagger
+        self._budget = (min_conn, max_conn)
+        self._lazy = lazy
+        self._pid = os.getpid()
+        self._cleanup_timeout = cleanup_timeout
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.transaction_pooling = transaction_pooling
+        self.recorder = recorder
+        self.tracer = tracer
+        self.profile_polls = profile_polls
+        self._connecting = {}
+        self.stats = stats or PoolStats()
         self.closed = False
-        self._ioloop = ioloop or IOLoop.instance()
+        self._ioloop = adapt(ioloop) if ioloop else None
         self._args = args
         self._kwargs = kwargs
 
+        if on_connect is None:
+            on_connect = []
+        elif isinstance(on_connect, basestring) or callable(on_connect):
+            on_connect = [on_connect]
+        self._on_connect = list(on_connect)
+        if transaction_pooling and not all(map(callable, self._on_connect)):
+            raise ValueError('on_connect queries change the session, which '
+                'is not kept with transaction_pooling')
+        self._typecasters = []
+        for typecaster in typecasters or ():
+            if isinstance(typecaster, basestring):
+                if typecaster not in TYPECASTERS:
+                    raise ValueError('unknown typecaster %r' % typecaster)
+                typecaster = (typecaster, TYPECASTERS[typecaster])
+            self._typecasters.append(tuple(typecaster))
+        self._oids = None
+        self._oid_waiters = None
+
+        self.lanes = dict(lanes or LANES)
+        if default_lane not in self.lanes:
+            raise ValueError('unknown default lane %r' % default_lane)
+        if sum(reserved for weight, reserved in self.lanes.values()) > max_conn:
+            raise ValueError('lanes reserve more than max_conn connections')
+        self.default_lane = default_lane
+        self._waiting = dict((lane, deque()) for lane in self.lanes)
+        self._in_use = dict((lane, 0) for lane in self.lanes)
+        self._pass = dict((lane, 0.0) for lane in self.lanes)
+        self._vtime = 0.0
+        self._service_time = 0.0
+
         self._pool = []
+        self._free = []
+        self._opening = 0
+        self._sessions = {}
+        self._warmups = []
+        self._inherited = set()
+        self._cleaner = None
+        self._started = False
 
-        for i in range(self.min_conn):
-            self._new_conn()
+        if processes is None:
+            self._start()
 
+    def _start(self):
+        """Pick the IOLoop, take this worker's share of the connections and
+        start the cleanup timer and the warmup.
+        """
+        self._started = True
+        if self._ioloop is None:
+            self._ioloop = current_ioloop()
+        self._take_share()
+        self._start_cleaner()
+        if not self._lazy:
+            self._start_warmup()
+
+    def _start_cleaner(self):
         # Create a periodic callback that tries to close inactive connections
-        if cleanup_timeout > 0:
-            self._cleaner = PeriodicCallback(self._clean_pool,
-                cleanup_timeout * 1000)
+        self._cleaner = None
+        if self._cleanup_timeout > 0:
+            self._cleaner = PeriodicTimer(self._ioloop, self._clean_pool,
+                self._cleanup_timeout)
             self._cleaner.start()
 
-    def _new_conn(self, new_cursor_args={}):
-        """Create a new connection.
+    def _take_share(self):
+        """Use this worker's share of the connection budget in a process that
+        was started by ``fork_processes``.
+        """
+        task = task_id()
+        if self.processes is None or task is None:
+            return
+        processes = self.processes or cpu_count()
+        min_conn, max_conn = self._budget
+        self.min_conn = fork_share(min_conn, processes, task)
+        self.max_conn = max(1, fork_share(max_conn, processes, task))
+
+    def _start_warmup(self):
+        delay = self.stagger * (task_id() or 0)
+        if delay > 0:
+            self._ioloop.add_timeout(datetime.timedelta(seconds=delay),
+                self._staggered_warmup)
+        else:
+            for i in range(self.min_conn):
+                self._new_conn()
+
+    def _staggered_warmup(self):
+        if not self.closed:
+            self.warmup(callback=self._warmup_done)
+
+    def _warmup_done(self, result):
+        if isinstance(result, Exception):
+            logging.warning('Could not warm up the pool: %s', result)
 
-        If `new_cursor_args` is provided a new cursor is created when the
-        callback is executed.
+    def _check_fork(self):
+        """Start the pool when it's used for the first time, and start over
+        when it's used in a forked child for the first time. The connections
+        of the parent, also the ones that are still being opened, are dropped
+        without ending their sessions, and the operations of the parent are
+        forgotten.
+        """
+        pid = os.getpid()
+        if pid == self._pid:
+            if not self._started and not self.closed:
+                self._start()
+            return
+        self._pid = pid
+        if self._cleaner is not None:
+            # The timer of the parent would close the inherited connections
+            self._cleaner.stop()
+            self._cleaner = None
+        self._inherited = set(self._pool) | set(self._connecting)
+        for conn in self._inherited:
+            _forget(conn)
+        self._pool = []
+        self._free = []
+        self._opening = 0
+        self._sessions = {}
+        self._warmups = []
+        self._connecting = {}
+        self._oid_waiters = None
+        for lane in self.lanes:
+            self._waiting[lane].clear()
+            self._in_use[lane] = 0
+        self.stats.reset()
+        if not self.closed:
+            self._start()
 
-        :param new_cursor_args: Arguments (dictionary) for a new cursor.
+    def _new_conn(self):
+        """Create a new connection. It's added to the pool once the connection
+        has been made.
         """
-        if len(self._pool) > self.max_conn:
-            raise PoolError('connection pool exausted')
         conn = psycopg2.connect(async=1, *self._args, **self._kwargs)
-        add_conn = functools.partial(self._add_conn, conn)
+        self._opening += 1
+        self._connecting[conn] = (time.time(), conn.fileno())
+        Poller(conn, (functools.partial(self._setup_conn, conn),),
+            ioloop=self._ioloop,
+            errback=functools.partial(self._connect_failed, conn))
 
-        if new_cursor_args:
-            new_cursor_args['connection'] = conn
-            new_cursor = functools.partial(self.new_cursor, **new_cursor_args)
-            Poller(conn, (add_conn, new_cursor), ioloop=self._ioloop)
-        else:
-            Poller(conn, (add_conn,), ioloop=self._ioloop)
+    def warmup(self, count=None, callback=None):
+        """Open connections in parallel until the pool has `count`
+        connections. The returned Future gets the amount of connections in the
+        pool when they're all open and set up, or the first error if a
+        connection couldn't be made. The callback gets the same.
+
+        :param count: The amount of connections. Defaults to ``min_conn``.
+        :param callback: A callable that is executed when the connections are
+                         open. Optional.
+        """
+        self._check_fork()
+        if self.closed:
+            raise PoolError('connection pool is closed')
+        if count is None:
+            count = self.min_conn
+        count = min(count, self.max_conn)
+        waiter = [count, create_future(self._ioloop), callback, None]
+        while len(self._pool) + self._opening < count:
+            try:
+                self._new_conn()
+            except Exception as error:
+                waiter[3] = error
+                break
+        self._warmups.append(waiter)
+        self._ioloop.add_callback(self._warmed)
+        return waiter[1]
+
+    def _warmed(self, error=None):
+        """Finish the warmups that have their connections, or that won't get
+        them because no connections are being opened anymore.
+        """
+        for waiter in self._warmups[:]:
+            count, future, callback, failure = waiter
+            if error is not None and failure is None:
+                failure = waiter[3] = error
+            if len(self._pool) < count and self._opening and not self.closed:
+                continue
+            self._warmups.remove(waiter)
+            if len(self._pool) >= count:
+                result = len(self._pool)
+                if future is not None:
+                    future.set_result(result)
+            else:
+                result = failure or PoolError('connection pool is closed')
+                if future is not None:
+                    future.set_exception(result)
+            if callback:
+                callback(result)
+
+    def _setup_steps(self):
+        if self._typecasters:
+            if self._oids is None:
+                yield self._fetch_oids
+            yield self._register_types
+        for step in self._on_connect:
+            if callable(step):
+                yield step
+            else:
+                yield functools.partial(self._setup_query, step)
+
+    def _setup_conn(self, conn, steps=None, error=None):
+        """Run the setup steps of a new connection one after another and add
+        it to the pool when they're done.
+        """
+        if conn in self._inherited:
+            return
+        if steps is None:
+            steps = list(self._setup_steps())
+        if error is not None:
+            conn.close()
+            self._connect_failed(conn, error)
+            return
+        if not steps or self.closed:
+            self._add_conn(conn)
+            return
+
+        step = steps.pop(0)
+        try:
+            step(conn, functools.partial(self._setup_conn, conn, steps))
+        except Exception as error:
+            self._setup_conn(conn, steps, error)
+
+    def _setup_query(self, query, conn, callback):
+        if isinstance(query, basestring):
+            query = [query]
+        cursor = conn.cursor()
+        cursor.execute(*query)
+        Poller(conn, (cursor.close, callback), ioloop=self._ioloop,
+            errback=callback)
+
+    def _fetch_oids(self, conn, callback):
+        """Fetch the OIDs of the types that need a typecaster. Connections that
+        are set up while the OIDs are being fetched wait for that fetch.
+        """
+        if self._oids is not None:
+            callback()
+            return
+        if self._oid_waiters is not None:
+            self._oid_waiters.append((conn, callback))
+            return
+        self._oid_waiters = []
+        cursor = conn.cursor()
+        cursor.execute('SELECT typname, oid, typarray FROM pg_type '
+            'WHERE typname IN %s;', (tuple(name for name, register
+                in self._typecasters),))
+        Poller(conn, (functools.partial(self._oids_fetched, cursor, callback),),
+            ioloop=self._ioloop,
+            errback=functools.partial(self._oids_failed, callback))
+
+    def _oids_fetched(self, cursor, callback):
+        oids = dict((name, (oid, array_oid))
+            for name, oid, array_oid in cursor.fetchall())
+        for name, register in self._typecasters:
+            if name not in oids:
+                self._oids_failed(callback,
+                    ProgrammingError('type %r does not exist' % name))
+                return
+        self._oids = oids
+        waiters, self._oid_waiters = self._oid_waiters or [], None
+        callback()
+        for conn, waiter in waiters:
+            waiter()
+
+    def _oids_failed(self, callback, error):
+        # The next waiting connection tries again
+        waiters, self._oid_waiters = self._oid_waiters or [], None
+        callback(error)
+        for conn, waiter in waiters:
+            try:
+                self._fetch_oids(conn, waiter)
+            except Exception as error:
+                waiter(error)
+
+    def _register_types(self, conn, callback):
+        for name, register in self._typecasters:
+            oid, array_oid = self._oids[name]
+            register(conn, oid, array_oid)
+        callback()
 
     def _add_conn(self, conn):
         """Add a connection to the pool.
 
-        This function is used by `_new_conn` as a callback to add the created
-        connection to the pool.
+        This function is used by `_setup_conn` to add the created connection
+        to the pool once it's set up.
 
         :param conn: A database connection.
         """
+        if conn in self._inherited:
+            return
+        self._opening -= 1
+        self._traced_connect(conn)
+        if self.closed:
+            conn.close()
+            self._warmed()
+            return
         self._pool.append(conn)
+        self._free.append(conn)
+        self._sessions[conn] = {}
+        self.stats.connection_opened()
+        self._warmed()
+        self._dispatch()
+
+    def _connect_failed(self, conn, error):
+        """Called when a connection could not be made. If there are no other
+        connections that can serve the waiting operations, the error is passed
+        on to the first waiting operation.
+        """
+        if conn in self._inherited:
+            return
+        self._opening -= 1
+        self._traced_connect(conn, error)
+        self._warmed(error)
+        logging.warning('Could not connect to the database: %s', error)
+        if self._pool or self.closed:
+            return
+        lane = self._next_lane()
+        if lane is not None:
+            self._finish(self._waiting[lane].popleft(), error)
+            self._dispatch()
+
+    def _traced_connect(self, conn, error=None):
+        connecting = self._connecting.pop(conn, None)
+        if connecting is not None and self.tracer is not None:
+            started, fileno = connecting
+            self.tracer.complete('connect', started, fileno,
+                {'error': str(error)} if error is not None else None)
 
-    def new_cursor(self, function, func_args=(), callback=None, connection=None, cursor_args={}):
+    def _drop_conn(self, conn):
+        """Remove a connection from the pool and close it.
+        """
+        if conn in self._pool:
+            self._pool.remove(conn)
+            self.stats.connection_closed()
+        if conn in self._free:
+            self._free.remove(conn)
+        self._sessions.pop(conn, None)
+        if not conn.closed:
+            conn.close()
+
+    def new_cursor(self, function, func_args=(), callback=None, connection=None,
+                   cursor_args={}, priority=None, deadline=None, session=None):
         """Create a new cursor.
 
-        If there's no connection available, a new connection will be created and
-        `new_cursor` will be called again after the connection has been made.
+        If there's no connection available, a new connection will be created
+        if the pool isn't full yet, and the operation waits in the queue of its
+        priority lane until a connection is free.
+
+        The callback receives the cursor or, if the operation failed, the
+        exception.
 
         :param function: ``execute``, ``executemany`` or ``callproc``.
         :param func_args: A tuple with the arguments for the specified function.
         :param callback: A callable that is executed once the operation is done.
+        :param connection: Run the operation on this free connection of the
+                           pool instead of waiting for one. A ``PoolError`` is
+                           raised when it's in use.
+        :param cursor_args: Arguments (dictionary) for the new cursor.
+        :param priority: The name of the lane. Defaults to ``default_lane``.
+        :param deadline: The time (as returned by ``time.time()``) at which the
+                         operation is cancelled and ``DeadlineExceeded`` is
+                         passed to the callback. The ``statement_timeout`` of
+                         an ``execute`` is set to the time that's left when
+                         the query is sent, except for statements that can't
+                         run in a transaction block, like ``VACUUM``.
+        :param session: A dictionary with run-time settings, e.g.
+                        ``{'search_path': 'tenant, public'}``, that must be set
+                        for the session of the connection. Settings that
+                        earlier operations set with ``session`` and that aren't
+                        in it are reset to their defaults. A ``SET`` in the
+                        query itself isn't tracked.
+        :return: An ``Operation`` that can be used to cancel the operation.
         """
-        if not connection:
-            connection = self._get_free_conn()
-            if not connection:
-                self._new_conn({
-                    'function': function,
-                    'func_args': func_args,
-                    'callback': callback,
-                    'cursor_args': cursor_args
-                })
+        self._check_fork()
+        if self.closed:
+            raise PoolError('connection pool is closed')
+        lane = priority or self.default_lane
+        if lane not in self.lanes:
+            raise ValueError('unknown priority %r' % lane)
+        settings = {}
+        for name, value in (session or {}).items():
+            if not SETTING_NAME.match(name):
+                raise ValueError('invalid setting name %r' % name)
+            settings[name.lower()] = '%s' % value
+        if connection is None:
+            self._check_load()
+        elif connection not in self._free:
+            raise PoolError('connection is in use' if connection in self._pool
+                else 'connection is not in the pool')
+        if self.transaction_pooling and (settings or deadline is not None):
+            function, func_args = self._pooled_function(function, func_args,
+                settings)
+
+        operation = Operation(self, function, func_args, callback, cursor_args,
+            lane, deadline, settings)
+        if self.recorder is not None:
+            operation._record = self.recorder.started(function, func_args,
+                lane, self.queue_depth + sum(self._in_use.values()))
+        if self.tracer is not None:
+            operation._trace = self.tracer.sample()
+            if operation._trace is not None:
+                self.tracer.begin(operation._trace, 'operation',
+                    {'function': function, 'lane': lane}, operation.queued)
+        if deadline is not None:
+            operation._timeout = self._ioloop.add_timeout(
+                datetime.timedelta(seconds=deadline - time.time()),
+                functools.partial(self._expire, operation))
+        if connection is not None:
+            self._free.remove(connection)
+            self._checkout(connection, operation)
+            return operation
+
+        if not self._waiting[lane]:
+            # Don't let a lane that was idle catch up on its share
+            self._pass[lane] = max(self._pass[lane], self._vtime)
+        self._waiting[lane].append(operation)
+        self._dispatch()
+        return operation
+
+    def _pooled_function(self, function, func_args, settings):
+        """Turn a ``callproc`` into an ``execute``, so the settings of the
+        operation can be set in the same transaction. A dictionary with
+        parameters is passed as named arguments (``name => value``).
+        """
+        if function == 'execute':
+            return function, func_args
+        if function != 'callproc':
+            if settings:
+                raise ValueError('session settings can only be used with '
+                    'execute and callproc with transaction_pooling')
+            return function, func_args
+        procname, parameters = func_args
+        if isinstance(parameters, dict):
+            for name in parameters:
+                if not ARGUMENT_NAME.match(name):
+                    raise ValueError('invalid argument name %r' % name)
+            query = 'SELECT * FROM %s(%s);' % (procname, ', '.join(
+                '%s => %%(%s)s' % (name, name) for name in sorted(parameters)))
+            return 'execute', (query, dict(parameters))
+        parameters = tuple(parameters or ())
+        query = 'SELECT * FROM %s(%s);' % (procname,
+            ', '.join(['%s'] * len(parameters)))
+        return 'execute', (query, parameters)
+
+    @property
+    def queue_depth(self):
+        """The amount of operations that are waiting for a connection.
+        """
+        return sum(len(queue) for queue in self._waiting.values())
+
+    @property
+    def expected_wait(self):
+        """The expected time in seconds a new operation has to wait for a
+        connection. It's estimated from the queue depth and a moving average
+        of the query duration.
+        """
+        if self._free or len(self._pool) + self._opening < self.max_conn:
+            return 0.0
+        return (self.queue_depth + 1) * self._service_time / self.max_conn
+
+    def _check_load(self):
+        """Raise a ``PoolOverloadError`` if a new operation would exceed
+        `max_queue` or `max_wait`.
+        """
+        if self.max_queue is not None and self.queue_depth >= self.max_queue:
+            self.stats.rejected()
+            raise PoolOverloadError('connection pool queue is full')
+        if self.max_wait is not None and self.expected_wait > self.max_wait:
+            self.stats.rejected()
+            raise PoolOverloadError('expected wait for a connection is too '
+                'long')
+
+    def _dispatch(self):
+        """Hand out free connections to waiting operations and open new
+        connections for the operations that are left.
+        """
+        while True:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            if not self._free:
+                waiting = sum(len(queue) for queue in self._waiting.values())
+                while self._opening < waiting and \
+                        len(self._pool) + self._opening < self.max_conn:
+                    try:
+                        self._new_conn()
+                    except Exception as error:
+                        self._finish(self._waiting[lane].popleft(), error)
+                        break
                 return
 
-        try:
-            cursor = connection.cursor(**cursor_args)
-            getattr(cursor, function)(*func_args)
+            operation = self._waiting[lane].popleft()
+            self._vtime = self._pass[lane]
+            self._pass[lane] += 1.0 / self.lanes[lane][0]
+            self._checkout(self._take_free(operation), operation)
 
-            # Callbacks from cursor functions always get the cursor back
-            if callback:
-                Poller(cursor.connection, (functools.partial(callback, cursor),),
-                    ioloop=self._ioloop)
-        except (DatabaseError, InterfaceError):
-            logging.warning('Requested connection was closed')
-            self._pool.remove(connection)
-            connection = self._get_free_conn()
-            if not connection:
-                self._new_conn({
-                    'function': function,
-                    'func_args': func_args,
-                    'callback': callback,
-                    'cursor_args': cursor_args
-                })
+    def _take_free(self, operation):
+        """Take the free connection with the session settings that differ the
+        least from the settings of the operation. The most recently used one
+        wins a tie.
+        """
+        wanted = set(operation.session.items())
+        best = best_changes = None
+        for index in range(len(self._free) - 1, -1, -1):
+            changes = len(wanted.symmetric_difference(
+                self._sessions[self._free[index]].items()))
+            if best is None or changes < best_changes:
+                best, best_changes = index, changes
+                if not changes:
+                    break
+        return self._free.pop(best)
+
+    def _next_lane(self):
+        """Return the lane that gets the next free connection, or `None` if no
+        operation can get one.
+        """
+        best = None
+        for lane, queue in self._waiting.items():
+            if queue and self._eligible(lane) and (best is None or
+                    self._pass[lane] < self._pass[best]):
+                best = lane
+        return best
+
+    def _eligible(self, lane):
+        """Check if `lane` can get a connection without taking one that is
+        reserved by another lane.
+        """
+        left = self.max_conn - sum(self._in_use.values()) - 1
+        reserved = 0
+        for other, (weight, minimum) in self.lanes.items():
+            if other != lane:
+                reserved += max(0, minimum - self._in_use[other])
+        return left >= reserved
+
+    def _checkout(self, connection, operation):
+        """Run an operation on a connection.
+        """
+        self._in_use[operation.lane] += 1
+        self.stats.checked_out(time.time() - operation.queued, operation.lane)
+        operation.connection = connection
+        if operation._trace is not None:
+            self.tracer.span(operation._trace, 'queued', operation.queued)
+            self.tracer.instant(operation._trace, 'checked out',
+                {'connection': connection.fileno()})
+            self.tracer.begin(operation._trace, 'query')
+        if self.profile_polls:
+            operation._counts = PollCounts(connection.fileno())
+        self._run(connection, operation)
+
+    def _run(self, connection, operation):
+        if connection in self._inherited:
+            return
+        try:
+            cursor = connection.cursor(**operation.cursor_args)
+            setup = self._session_sql(connection, cursor, operation)
+            if setup:
+                self.stats.session_changed()
+            query = self._prefixable(connection, operation)
+            if setup and query is None:
+                if self.transaction_pooling:
+                    raise ValueError('session settings can\'t be used with '
+                        'statements that can\'t run in a transaction with '
+                        'transaction_pooling')
+                # Only an execute can carry the settings in its own query
+                cursor.execute(setup)
+                Poller(connection, (cursor.close,
+                        functools.partial(self._session_done, connection,
+                            operation),
+                        functools.partial(self._run, connection, operation)),
+                    ioloop=self._ioloop,
+                    errback=functools.partial(self._query_failed, connection,
+                        operation),
+                    trace=self._poll_trace(operation),
+                    counts=operation._counts)
+                return
+            getattr(cursor, operation.function)(
+                *self._func_args(operation, setup, query))
+        except Exception as error:
+            if operation._trace is not None:
+                self.tracer.end(operation._trace, 'query',
+                    {'error': type(error).__name__})
+            self._checkin(connection, operation)
+            if connection.closed:
+                logging.warning('Requested connection was closed')
+                self._waiting[operation.lane].appendleft(operation)
+                self._dispatch()
             else:
-                self.new_cursor(function, func_args, callback, connection)
+                self._finish(operation, error)
+            return
 
-    def _get_free_conn(self):
-        """Look for a free connection and return it.
+        # Callbacks from cursor functions always get the cursor back
+        Poller(connection, (functools.partial(self._query_done, connection,
+                cursor, operation, time.time()),),
+            ioloop=self._ioloop,
+            errback=functools.partial(self._query_failed, connection, operation),
+            trace=self._poll_trace(operation), counts=operation._counts)
 
-        `None` is returned when no free connection can be found.
+    def _poll_trace(self, operation):
+        if operation._trace is None:
+            return None
+        return functools.partial(self.tracer.poll, operation._trace)
+
+    def _session_sql(self, connection, cursor, operation):
+        """Return the statements that change the session settings of the
+        connection to the ones of the operation, or an empty string.
         """
-        if self.closed:
-            raise PoolError('connection pool is closed')
-        for conn in self._pool:
-            if not conn.isexecuting():
-                return conn
-        return None
+        if self.transaction_pooling:
+            current = {}
+        else:
+            current = self._sessions.get(connection, {})
+        wanted = operation.session
+        if current == wanted:
+            return ''
+        statements = []
+        parameters = []
+        for name in sorted(current):
+            if name not in wanted:
+                statements.append('RESET %s;' % name)
+        for name, value in sorted(wanted.items()):
+            if current.get(name) != value:
+                # Settings that are local to the transaction with a pooler
+                statements.append('SELECT set_config(%%s, %%s, %s);' % (
+                    'true' if self.transaction_pooling else 'false'))
+                parameters.extend((name, value))
+        sql = cursor.mogrify(' '.join(statements), parameters)
+        if not isinstance(sql, str):
+            sql = sql.decode(psycopg2.extensions.encodings[connection.encoding])
+        return sql + ' '
+
+    def _session_done(self, connection, operation):
+        if not self.transaction_pooling:
+            self._sessions[connection] = operation.session
+
+    def _prefixable(self, connection, operation):
+        """Return the query of an ``execute`` as a string that statements can
+        be put in front of, or ``None`` if that's not possible.
+        """
+        if operation.function != 'execute':
+            return None
+        query = operation.func_args[0]
+        if hasattr(query, 'as_string'):
+            # A psycopg2.sql.Composable
+            query = query.as_string(connection)
+        if not isinstance(query, basestring) or NO_TRANSACTION.match(query):
+            return None
+        return query
+
+    def _func_args(self, operation, setup='', query=None):
+        """Prefix the query of an ``execute`` with the statements that change
+        the session settings and, if it has a deadline, a ``statement_timeout``
+        that's only valid for the implicit transaction of the query. The
+        timeout has no effect inside an explicit transaction block.
+
+        The statements are part of the implicit transaction of the query, so
+        if the query fails the settings are rolled back as well.
+
+        :param query: The query as returned by ``_prefixable``. Without it the
+                      arguments are used as they are.
+        """
+        if query is None:
+            return operation.func_args
+        prefix = setup
+        if operation.deadline is not None:
+            left = int((operation.deadline - time.time()) * 1000)
+            prefix += 'SET LOCAL statement_timeout = %d; ' % max(left, 1)
+        if not prefix:
+            return operation.func_args
+        parameters = operation.func_args[1:]
+        if parameters and parameters[0] is not None:
+            prefix = prefix.replace('%', '%%')
+        return (prefix + query,) + tuple(parameters)
+
+    def _checkin(self, connection, operation):
+        """Return a connection to the pool after an operation.
+        """
+        self._in_use[operation.lane] -= 1
+        self.stats.checked_in()
+        operation.connection = None
+        if connection.closed or self.closed:
+            self._drop_conn(connection)
+        else:
+            self._free.append(connection)
+
+    def _query_done(self, connection, cursor, operation, started):
+        """Record statistics for a finished operation, return its connection
+        and run its callback.
+        """
+        if connection in self._inherited:
+            return
+        duration = time.time() - started
+        if operation._trace is not None:
+            self.tracer.end(operation._trace, 'query')
+        self.stats.query_done(duration)
+        self._service_time += (duration - self._service_time) * 0.2
+        self._session_done(connection, operation)
+        self._checkin(connection, operation)
+        # Run the callback first, so operations finish in the order they were
+        # handed a connection and queries from the callback are queued fairly
+        try:
+            self._finish(operation, cursor)
+        finally:
+            self._dispatch()
+
+    def _query_failed(self, connection, operation, error):
+        if connection in self._inherited:
+            return
+        if operation._trace is not None:
+            self.tracer.end(operation._trace, 'query',
+                {'error': type(error).__name__})
+        self._checkin(connection, operation)
+        if (isinstance(error, QueryCanceledError) and
+                operation.deadline is not None and not operation.cancelled):
+            # The statement_timeout derived from the deadline expired
+            error = DeadlineExceeded('deadline exceeded')
+        try:
+            self._finish(operation, error)
+        finally:
+            self._dispatch()
+
+    def _expire(self, operation):
+        """Cancel an operation that's still waiting or running when its
+        deadline passes and pass ``DeadlineExceeded`` to its callback.
+        """
+        operation._timeout = None
+        callback = operation.callback
+        operation.cancel()
+        if callback:
+            callback(DeadlineExceeded('deadline exceeded'))
+
+    def _finish(self, operation, result):
+        if operation._timeout is not None:
+            self._ioloop.remove_timeout(operation._timeout)
+            operation._timeout = None
+        if operation._record is not None:
+            self.recorder.finished(operation._record,
+                result if isinstance(result, Exception) else None)
+        trace = operation._trace
+        started = time.time()
+        try:
+            if operation.callback:
+                operation.callback(result)
+            elif isinstance(result, Exception) and not operation.cancelled:
+                logging.error('Query failed: %s', result)
+        finally:
+            if operation._counts is not None:
+                self.stats.polled(operation._counts, time.time() - started,
+                    operation.function, operation.func_args[0])
+            if trace is not None:
+                self.tracer.span(trace, 'callback', started)
+                self.tracer.end(trace, 'operation',
+                    {'error': type(result).__name__}
+                    if isinstance(result, Exception) else None)
+
+    def _cancel(self, operation):
+        """Remove a waiting operation from its queue or cancel a running query.
+        The connection is returned to the pool by the errback of the poller,
+        which gets a ``QueryCanceledError``.
+        """
+        queue = self._waiting[operation.lane]
+        if operation in queue:
+            queue.remove(operation)
+            self.stats.cancelled()
+            if operation._record is not None:
+                self.recorder.finished(operation._record,
+                    psycopg2.extensions.QueryCanceledError())
+            if operation._trace is not None:
+                self.tracer.span(operation._trace, 'queued', operation.queued)
+                self.tracer.end(operation._trace, 'operation',
+                    {'cancelled': True})
+        elif operation.connection is not None:
+            self.stats.cancelled()
+            try:
+                operation.connection.cancel()
+            except (DatabaseError, InterfaceError) as error:
+                logging.warning('Could not cancel query: %s', error)
+        if operation._timeout is not None:
+            self._ioloop.remove_timeout(operation._timeout)
+            operation._timeout = None
 
     def _clean_pool(self):
         """Close a number of inactive connections when the number of connections
         in the pool exceeds the number in `min_conn`.
         """
+        self._check_fork()
         if self.closed:
-            raise PoolError('connection pool is closed')
-        if len(self._pool) > self.min_conn:
-            conns = len(self._pool) - self.min_conn
-            for conn in self._pool[:]:
-                if not conn.isexecuting():
-                    conn.close()
-                    conns = conns - 1
-                    self._pool.remove(conn)
-                    if conns == 0:
-                        break
+            return
+        conns = len(self._pool) - self.min_conn
+        if conns > 0:
+            # The least recently used connections are at the front
+            for conn in self._free[:conns]:
+                self._drop_conn(conn)
 
     def close(self):
-        """Close all open connections in the pool.
+        """Close all open connections in the pool. Operations that are still
+        waiting for a connection get a ``PoolError``.
         """
         if self.closed:
             raise PoolError('connection pool is closed')
-        for conn in self._pool:
-            if not conn.closed:
-                conn.close()
-        self._cleaner.stop()
-        self._pool = []
         self.closed = True
+        for conn in self._pool[:]:
+            self._drop_conn(conn)
+        if self._cleaner is not None:
+            self._cleaner.stop()
+        for queue in self._waiting.values():
+            while queue:
+                self._finish(queue.popleft(),
+                    PoolError('connection pool is closed'))
+
+
+class ShardedPool(object):
+    """A pool for a client that's shared by several IOLoops, each running in
+    its own thread. Every IOLoop gets its own ``AsyncPool`` shard, which is
+    created the first time an operation is started from the thread of that
+    IOLoop, so connections and their callbacks never cross threads.
+
+    All arguments are passed to the shards, so ``min_conn`` and ``max_conn``
+    are per IOLoop. The shards share one ``PoolStats`` instance.
+
+    **Note:** This needs ``IOLoop.current``, Tornado 3 or newer.
+    """
+    def __init__(self, stats=None, **settings):
+        if IOLoop is None:
+            raise ImportError('ShardedPool requires Tornado')
+        if settings.get('ioloop') is not None:
+            raise ValueError('a sharded pool uses the IOLoop of every thread')
+        settings.pop('ioloop', None)
+        self.stats = stats or PoolStats()
+        self.closed = False
+        self._settings = settings
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shards(self):
+        """A dictionary with the ``AsyncPool`` of every IOLoop.
+        """
+        with self._lock:
+            return dict(self._shards)
+
+    def shard(self):
+        """Return the ``AsyncPool`` of the IOLoop of the current thread.
+        """
+        ioloop = IOLoop.current(instance=False)
+        if ioloop is None:
+            raise PoolError('no IOLoop in this thread')
+        pool = self._shards.get(ioloop)
+        if pool is None:
+            with self._lock:
+                if self.closed:
+                    raise PoolError('connection pool is closed')
+                pool = self._shards.get(ioloop)
+                if pool is None:
+                    pool = self._shards[ioloop] = AsyncPool(ioloop=ioloop,
+                        stats=self.stats, **self._settings)
+        return pool
+
+    def new_cursor(self, *args, **kwargs):
+        """Start an operation on the shard of the current IOLoop. See
+        ``AsyncPool.new_cursor``.
+        """
+        return self.shard().new_cursor(*args, **kwargs)
+
+    def warmup(self, count=None, callback=None):
+        return self.shard().warmup(count, callback)
+
+    @property
+    def queue_depth(self):
+        return self.shard().queue_depth
+
+    @property
+    def expected_wait(self):
+        return self.shard().expected_wait
+
+    def close_shard(self):
+        """Close the shard of the current IOLoop, e.g. before the IOLoop of a
+        thread is closed.
+        """
+        ioloop = IOLoop.current(instance=False)
+        with self._lock:
+            pool = self._shards.pop(ioloop, None)
+        if pool is not None:
+            pool.close()
+
+    def close(self):
+        """Close all shards. Shards of other threads are closed on their own
+        IOLoop.
+        """
+        with self._lock:
+            if self.closed:
+                raise PoolError('connection pool is closed')
+            self.closed = True
+            shards, self._shards = self._shards, {}
+        current = IOLoop.current(instance=False)
+        for ioloop, pool in shards.items():
+            if ioloop is current:
+                pool.close()
+            else:
+                ioloop.add_callback(pool.close)
+
+
+class Operation(object):
+    """An operation that is waiting for, or running on, a connection. It's
+    returned by ``AsyncPool.new_cursor`` and the query functions of
+    ``AsyncClient`` and can be used to cancel the operation, e.g. when the
+    client of a request handler goes away::
+
+        def get(self):
+            self.operation = self.db.execute('SELECT ...;',
+                callback=self.on_result)
+
+        def on_connection_close(self):
+            self.operation.cancel()
+    """
+    __slots__ = ('function', 'func_args', 'callback', 'cursor_args', 'lane',
+        'queued', 'connection', 'cancelled', 'deadline', 'session', '_timeout',
+        '_record', '_trace', '_counts', '_pool')
+
+    def __init__(self, pool, function, func_args, callback, cursor_args, lane,
+                 deadline=None, session=None):
+        self.function = function
+        self.func_args = func_args
+        self.callback = callback
+        self.cursor_args = cursor_args
+        self.lane = lane
+        self.queued = time.time()
+        self.connection = None
+        self.cancelled = False
+        self.deadline = deadline
+        self.session = session or {}
+        self._timeout = None
+        self._record = None
+        self._trace = None
+        self._counts = None
+        self._pool = pool
+
+    def cancel(self):
+        """Cancel the operation. The callback won't be executed.
+
+        A waiting operation is removed from the queue. A running query is
+        cancelled on the server and its connection goes back to the pool as
+        soon as it's ready again.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.callback = None
+        self._pool._cancel(self)
+
+
+class PoolStats(object):
+    """Statistics of one or more connection pools.
+
+    The same instance can be passed to several pools, e.g. the ``AsyncPool``
+    of an ``AsyncClient`` and the ``BlockingPool`` of a ``ThreadedClient``, to
+    get combined numbers. Counters are updated under a lock, so pools that are
+    used from several threads can share an instance.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        self.rejections = 0
+        self.cancellations = 0
+        self.session_changes = 0
+        self.lanes = {}
+        self.polls = 0
+        self.poll_flips = 0
+        self.handler_registrations = 0
+        self.dispatch_time = 0.0
+        self.profiled_queries = 0
+        self.poll_connections = {}
+        self.poll_outliers = []
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+            self.connections_opened += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.connections -= 1
+            self.connections_closed += 1
+
+    def checked_out(self, wait=0.0, lane=None):
+        """Record a connection checkout that had to wait `wait` seconds. The
+        wait times of priority lanes are also kept per lane in ``lanes``.
+        """
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+            if lane is not None:
+                stats = self.lanes.get(lane)
+                if stats is None:
+                    stats = self.lanes[lane] = {'checkouts': 0,
+                        'wait_time': 0.0, 'max_wait_time': 0.0}
+                stats['checkouts'] += 1
+                stats['wait_time'] += wait
+                stats['max_wait_time'] = max(stats['max_wait_time'], wait)
+
+    def checked_in(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def query_done(self, duration):
+        """Record an operation that took `duration` seconds.
+        """
+        with self._lock:
+            self.queries += 1
+            self.query_time += duration
+
+    def rejected(self):
+        """Record an operation that was rejected because the pool was
+        overloaded.
+        """
+        with self._lock:
+            self.rejections += 1
+
+    def cancelled(self):
+        """Record an operation that was cancelled.
+        """
+        with self._lock:
+            self.cancellations += 1
+
+    def session_changed(self):
+        """Record a change of the session settings of a connection.
+        """
+        with self._lock:
+            self.session_changes += 1
+
+    def polled(self, counts, dispatch_time, function, query):
+        """Add the ``PollCounts`` of an operation and the time its callback
+        took. The counts are also kept per file descriptor of the connection in
+        ``poll_connections``, and the operations with the most polls in
+        ``poll_outliers``.
+        """
+        with self._lock:
+            self.profiled_queries += 1
+            self.polls += counts.polls
+            self.poll_flips += counts.flips
+            self.handler_registrations += counts.registrations
+            self.dispatch_time += dispatch_time
+            stats = self.poll_connections.get(counts.connection)
+            if stats is None:
+                stats = self.poll_connections[counts.connection] = {
+                    'queries': 0, 'polls': 0, 'flips': 0, 'registrations': 0}
+            stats['queries'] += 1
+            stats['polls'] += counts.polls
+            stats['flips'] += counts.flips
+            stats['registrations'] += counts.registrations
+            outliers = self.poll_outliers
+            if len(outliers) < OUTLIERS or counts.polls > outliers[-1][0]:
+                if not isinstance(query, basestring):
+                    query = repr(query)
+                outliers.append((counts.polls, function, query[:200]))
+                outliers.sort(key=lambda outlier: -outlier[0])
+                del outliers[OUTLIERS:]
+
+    def reset(self):
+        """Set all counters back to zero, e.g. in a forked worker.
+        """
+        self.__init__()
+
+    def as_dict(self):
+        """Return a snapshot of all counters as a dictionary.
+        """
+        with self._lock:
+            stats = dict((key, value) for key, value in self.__dict__.items()
+                if not key.startswith('_'))
+            stats['lanes'] = dict((lane, dict(values))
+                for lane, values in self.lanes.items())
+            stats['poll_connections'] = dict((fileno, dict(values))
+                for fileno, values in self.poll_connections.items())
+            stats['poll_outliers'] = list(self.poll_outliers)
+            return stats
 
 
 class PoolError(Exception):
     pass
+
+
+class PoolOverloadError(PoolError):
+    """Raised when an operation is rejected because the queue of the pool is
+    full or the expected wait for a connection is too long.
+    """
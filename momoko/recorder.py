@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.recorder
+    ~~~~~~~~~~~~~~~
+
+    Record the operations that reach a pool and replay them against another
+    database with the same arrival pattern.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import json
+import time
+import numbers
+import datetime
+import functools
+
+from .loops import adapt, current_ioloop
+
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def _default(value):
+    # Values JSON doesn't know are recorded as strings, which PostgreSQL casts
+    # back when they're used as literals
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode('latin-1')
+    return str(value)
+
+
+def _placeholder(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, numbers.Number):
+        return 0
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return type(value).min
+    if isinstance(value, (list, tuple)):
+        return [_placeholder(item) for item in value]
+    return ''
+
+
+def redact_parameters(function, query, parameters):
+    """Replace all parameters by placeholders of the same kind: numbers become
+    ``0``, strings ``''``, dates and times their minimum and lists keep their
+    length. ``None`` and booleans are kept. The queries can still be
+    replayed, but no data leaves the application.
+    """
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return dict((key, _placeholder(value))
+            for key, value in parameters.items())
+    return [_placeholder(value) for value in parameters]
+
+
+class Recorder(object):
+    """Records operations in an append-only file with one JSON array per line.
+    Every distinct query is written once and referred to by a number::
+
+        ["q", 0, "SELECT * FROM users WHERE id = %s;"]
+        ["o", 0, 0.0, 0, "execute", [42], "normal", 1]
+        ["d", 0, 0.00042, null]
+
+    ``q`` lines define a query, ``o`` lines are operations (number, time in
+    seconds since the start of the recording, query, function, parameters,
+    priority lane and the amount of operations that were waiting or running)
+    and ``d`` lines record the duration and error of an operation.
+
+    A recorder is passed to a pool as ``recorder``::
+
+        db = momoko.AsyncClient({
+            'database': 'app',
+            'recorder': Recorder('/var/tmp/app.workload', redact=True)
+        })
+
+    :param file: A file name or a file object that's opened for appending.
+    :param redact: ``True`` to replace the parameters by placeholders with
+                   ``redact_parameters``, or a callable that gets the
+                   function, query and parameters and returns the parameters
+                   that are recorded.
+    """
+    def __init__(self, file, redact=False):
+        if isinstance(file, basestring):
+            file = open(file, 'a')
+        self._file = file
+        self._redact = redact_parameters if redact is True else redact
+        self._queries = {}
+        self._started = {}
+        self._count = 0
+        self._epoch = time.time()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':'),
+            default=_default) + '\n')
+
+    def started(self, function, func_args, lane, in_flight):
+        """Record a new operation and return its number.
+        """
+        query, parameters = func_args[0], func_args[1:]
+        parameters = parameters[0] if parameters else None
+        if not isinstance(query, basestring):
+            # A pipeline has a list of (query, parameters) tuples
+            if self._redact:
+                query = [(sql, self._redact(function, sql, values))
+                    for sql, values in query]
+            query = json.dumps(query, default=_default)
+        elif self._redact and parameters is not None:
+            if function == 'executemany':
+                # A sequence with a set of parameters per execution
+                parameters = [self._redact(function, query, values)
+                    for values in parameters]
+            else:
+                parameters = self._redact(function, query, parameters)
+
+        query_id = self._queries.get(query)
+        if query_id is None:
+            query_id = self._queries[query] = len(self._queries)
+            self._write(['q', query_id, query])
+
+        number = self._count
+        self._count += 1
+        now = time.time()
+        self._started[number] = now
+        self._write(['o', number, round(now - self._epoch, 6), query_id,
+            function, parameters, lane, in_flight])
+        return number
+
+    def finished(self, number, error=None):
+        """Record the end of an operation.
+        """
+        started = self._started.pop(number, None)
+        if started is None:
+            return
+        self._write(['d', number, round(time.time() - started, 6),
+            None if error is None else type(error).__name__])
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_operations(file):
+    """Read a recording and yield ``(time, function, query, parameters,
+    lane)`` tuples for all operations.
+    """
+    if isinstance(file, basestring):
+        file = open(file)
+    queries = {}
+    for line in file:
+        record = json.loads(line)
+        if record[0] == 'q':
+            queries[record[1]] = record[2]
+        elif record[0] == 'o':
+            number, offset, query_id, function, parameters, lane = record[1:7]
+            yield offset, function, queries[query_id], parameters, lane
+
+
+class Replayer(object):
+    """Replays a recording with an ``AsyncClient`` with the same arrival
+    pattern. Operations are started at the time they were recorded, divided
+    by `speed`, regardless of how long the previous ones take.
+
+    The callback gets a dictionary with the amount of ``operations`` and
+    ``errors``, the ``elapsed`` time, the ``latencies`` of all operations and
+    the ``max_lag``, the largest delay in starting an operation. A large lag
+    means the replay itself couldn't keep up.
+
+    :param db: A ``momoko.AsyncClient`` instance.
+    :param file: A file name or a file object with a recording.
+    :param speed: How much faster than recorded the operations are started.
+    :param callback: The function that's called when all operations are done.
+    :param ioloop: An instance of Tornado's IOLoop.
+    """
+    def __init__(self, db, file, speed=1.0, callback=None, ioloop=None):
+        self._db = db
+        self._operations = read_operations(file)
+        self._speed = float(speed)
+        self._callback = callback
+        self._ioloop = adapt(ioloop) if ioloop else current_ioloop()
+        self._running = 0
+        self._done = False
+        self.operations = 0
+        self.errors = 0
+        self.latencies = []
+        self.max_lag = 0.0
+
+    def start(self):
+        self._started = time.time()
+        self._next()
+
+    def _next(self):
+        for offset, function, query, parameters, lane in self._operations:
+            due = self._started + offset / self._speed
+            if due > time.time():
+                self._ioloop.add_timeout(datetime.timedelta(
+                    seconds=due - time.time()), functools.partial(self._run,
+                        due, function, query, parameters, lane))
+                return
+            self._run(due, function, query, parameters, lane, schedule=False)
+        self._done = True
+        self._check_done()
+
+    def _run(self, due, function, query, parameters, lane, schedule=True):
+        now = time.time()
+        self.max_lag = max(self.max_lag, now - due)
+        self.operations += 1
+        self._running += 1
+        callback = functools.partial(self._finished, now)
+        try:
+            if function == 'callproc':
+                self._db.callproc(query, parameters, callback=callback,
+                    priority=lane)
+            elif function == 'execute_pipeline':
+                self._db.pipeline(json.loads(query), callback=callback,
+                    priority=lane)
+            elif function == 'execute':
+                self._db.execute(query, parameters, callback=callback,
+                    priority=lane)
+            else:
+                # E.g. executemany, which the clients don't have
+                self._db._pool.new_cursor(function, (query, parameters),
+                    callback, priority=lane)
+        except Exception as error:
+            # E.g. a PoolOverloadError when the pool sheds load
+            callback(error)
+        if schedule:
+            self._next()
+
+    def _finished(self, started, result):
+        self._running -= 1
+        if isinstance(result, Exception):
+            self.errors += 1
+        else:
+            self.latencies.append(time.time() - started)
+        self._check_done()
+
+    def _check_done(self):
+        if self._done and not self._running and self._callback:
+            callback, self._callback = self._callback, None
+            callback({
+                'operations': self.operations,
+                'errors': self.errors,
+                'elapsed': time.time() - self._started,
+                'latencies': self.latencies,
+                'max_lag': self.max_lag,
+            })
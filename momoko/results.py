@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.results
+    ~~~~~~~~~~~~~~
+
+    Alternative ways to turn query results into Python objects.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import array
+import numbers
+import functools
+from collections import OrderedDict
+
+from psycopg2 import ProgrammingError
+from psycopg2.extensions import cursor as _cursor, string_types, new_type, \
+    register_type
+from .loops import adapt, current_ioloop
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Types whose typecasters need a real cursor (time zones) or return objects
+# that can't be pickled (bytea). These are decoded in the calling process.
+_LOCAL_OIDS = frozenset((
+    17,    # bytea
+    1001,  # bytea[]
+    1184,  # timestamptz
+    1185,  # timestamptz[]
+    1266,  # timetz
+    1270,  # timetz[]
+))
+
+
+# Array typecodes for the types that have a fixed size. Python 2 has no
+# typecode for long long, but long is 64 bits on the platforms that matter.
+_INT8 = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+_TYPECODES = {
+    16: 'b',     # bool
+    20: _INT8,   # int8
+    21: 'h',     # int2
+    23: 'i',     # int4
+    26: 'I',     # oid
+    700: 'f',    # float4
+    701: 'd',    # float8
+}
+
+
+def _raw(value, cursor):
+    return value
+
+
+class RawCursor(_cursor):
+    """A cursor that returns the columns of all types that have a global
+    typecaster as raw text. The oids of those types are stored in
+    ``raw_oids``.
+
+    Registered typecasters are looked up when the result of a query arrives,
+    so they have to be in place before the query is executed.
+    """
+    def __init__(self, *args, **kwargs):
+        super(RawCursor, self).__init__(*args, **kwargs)
+        local = getattr(self.connection, 'string_types', {})
+        self.raw_oids = frozenset(oid for oid in string_types
+            if oid not in local and oid not in _LOCAL_OIDS)
+        register_type(new_type(tuple(self.raw_oids), 'MOMOKO_RAW', _raw), self)
+
+
+def _decode_chunk(oids, rows):
+    """Decode a chunk of raw rows with the global typecasters. Columns with an
+    oid of ``None`` are left untouched.
+
+    This function runs in a worker process.
+    """
+    casters = [string_types[oid] if oid is not None else None for oid in oids]
+    decoded = []
+    for row in rows:
+        decoded.append(tuple(
+            value if caster is None or value is None else caster(value, None)
+            for caster, value in zip(casters, row)))
+    return decoded
+
+
+class ProcessDecoder(object):
+    """Decodes query results in chunks on a process pool, so the IOLoop isn't
+    blocked while big results are turned into Python objects.
+
+    Pass an instance as ``decoder`` to ``AsyncClient.execute``. The query is
+    executed with a ``RawCursor``, so psycopg2 returns the columns as raw text,
+    which is cheap, and the chunks are decoded by the typecasters in the
+    worker processes.
+
+    Only globally registered typecasters are used in the workers, so register
+    them before the process pool is created. Columns with connection or cursor
+    specific typecasters, time zone aware types and ``bytea`` are decoded in
+    the calling process as usual.
+
+    :param executor: A ``concurrent.futures.ProcessPoolExecutor``.
+    :param chunk_size: The amount of rows that is decoded per chunk.
+    :param chunk_callback: A callable that is executed with a list of decoded
+                           rows as soon as a chunk is decoded. Chunks are
+                           passed on in order. Optional.
+    :param ioloop: An instance of Tornado's IOLoop.
+    """
+    def __init__(self, executor, chunk_size=1000, chunk_callback=None,
+                 ioloop=None):
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.chunk_callback = chunk_callback
+        self._ioloop = adapt(ioloop) if ioloop else current_ioloop()
+
+    cursor_factory = RawCursor
+
+    def decode(self, cursor, callback=None):
+        """Fetch all rows from `cursor` and decode them on the process pool.
+
+        The callback is executed with a list of all decoded rows or, when a
+        ``chunk_callback`` is used, with the amount of rows. Exceptions are
+        passed on to the callback.
+
+        :param cursor: A ``RawCursor`` with a finished query.
+        :param callback: A callable that is executed once all rows have been
+                         decoded. Optional.
+        """
+        if isinstance(cursor, Exception) or cursor.description is None:
+            if callback:
+                callback(cursor)
+            return
+
+        oids = tuple(column[1] if column[1] in cursor.raw_oids else None
+            for column in cursor.description)
+        _DecodeJob(self, cursor, oids, callback).start()
+
+
+class _DecodeJob(object):
+    """The state of one `ProcessDecoder.decode` call.
+    """
+    def __init__(self, decoder, cursor, oids, callback):
+        self._decoder = decoder
+        self._cursor = cursor
+        self._oids = oids
+        self._callback = callback
+        self._rows = [] if decoder.chunk_callback is None else None
+        self._count = 0
+        self._chunks = {}
+        self._submitted = 0
+        self._delivered = 0
+        self._failed = False
+
+    def start(self):
+        decoder = self._decoder
+        try:
+            while True:
+                rows = self._cursor.fetchmany(decoder.chunk_size)
+                if not rows:
+                    break
+                work = decoder.executor.submit(_decode_chunk, self._oids, rows)
+                work.add_done_callback(functools.partial(self._done,
+                    self._submitted))
+                self._submitted += 1
+        except Exception as error:
+            self._fail(error)
+            return
+        if not self._submitted:
+            self._finish()
+
+    def _done(self, index, work):
+        # Runs in one of the executor's threads
+        self._decoder._ioloop.add_callback(
+            functools.partial(self._collect, index, work))
+
+    def _collect(self, index, work):
+        if self._failed:
+            return
+        error = work.exception()
+        if error is not None:
+            self._fail(error)
+            return
+        self._chunks[index] = work.result()
+
+        # Pass chunks on in order, even if they finish out of order
+        while self._delivered in self._chunks:
+            rows = self._chunks.pop(self._delivered)
+            self._delivered += 1
+            self._count += len(rows)
+            if self._rows is None:
+                self._decoder.chunk_callback(rows)
+            else:
+                self._rows.extend(rows)
+
+        if self._delivered == self._submitted:
+            self._finish()
+
+    def _finish(self):
+        if self._callback:
+            self._callback(self._count if self._rows is None else self._rows)
+
+    def _fail(self, error):
+        self._failed = True
+        if self._callback:
+            self._callback(error)
+
+
+class ColumnarCursor(_cursor):
+    """A cursor that can fetch a result column by column, without building a
+    tuple for every row.
+
+    Pass it as ``cursor_factory`` in the cursor arguments and call
+    ``fetchcolumns`` on the cursor that is passed on to the callback::
+
+        db.execute('SELECT id, price FROM products;',
+            args={'cursor_factory': ColumnarCursor}, callback=on_result)
+
+        def on_result(cursor):
+            columns = cursor.fetchcolumns()
+            total = columns['price'].sum()
+    """
+    def fetchcolumns(self, use_numpy=None):
+        """Fetch all remaining rows and return them as an ordered dictionary
+        with a column per column name.
+
+        Columns of a fixed size type (``bool``, ``int2``, ``int4``, ``int8``,
+        ``oid``, ``float4`` and ``float8``) are returned as ``array.array``
+        objects, or as NumPy arrays that share the memory of those arrays if
+        NumPy is used. Other columns and columns that contain ``NULL`` values
+        are returned as lists.
+
+        :param use_numpy: Return NumPy arrays. Defaults to ``True`` if NumPy is
+                          installed.
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+
+        names = [column[0] for column in self.description]
+        typecodes = [_TYPECODES.get(column[1]) for column in self.description]
+        for name in names:
+            if names.count(name) > 1:
+                raise ProgrammingError('duplicate column name %r' % name)
+
+        sink = _ColumnSink(typecodes)
+        self.row_factory = lambda cursor: sink
+        try:
+            while self.fetchmany(1000):
+                pass
+        finally:
+            self.row_factory = None
+
+        columns = OrderedDict()
+        for name, column in zip(names, sink.columns):
+            if use_numpy and isinstance(column, array.array):
+                dtype = bool if column.typecode == 'b' else column.typecode
+                column = numpy.frombuffer(column, dtype=dtype)
+            columns[name] = column
+        return columns
+
+
+class _ColumnSink(object):
+    """Takes the place of a row while psycopg2 fetches a row and appends every
+    value to its column.
+    """
+    __slots__ = ('columns', '_appends')
+
+    def __init__(self, typecodes):
+        self.columns = [array.array(typecode) if typecode else []
+            for typecode in typecodes]
+        self._appends = [column.append for column in self.columns]
+
+    def __setitem__(self, index, value):
+        try:
+            self._appends[index](value)
+        except TypeError:
+            # A NULL value, fall back to a list for the whole column
+            column = list(self.columns[index])
+            column.append(value)
+            self.columns[index] = column
+            self._appends[index] = column.append
+
+
+# Record classes by column names and lazy typecasters
+_record_classes = {}
+
+
+class RecordCursor(_cursor):
+    """A cursor that returns compact records instead of tuples or
+    dictionaries. Pass it as ``cursor_factory`` in the cursor arguments.
+
+    Records use ``__slots__`` and support access by attribute, by column name
+    and by index. The record class is created once for every combination of
+    column names and types and reused for later results.
+
+    Columns of the types in ``lazy_oids`` (numeric, dates and times, JSON)
+    are stored as raw text and decoded by their typecaster the first time
+    they are accessed. Time zone aware types need a cursor to be decoded and
+    are never decoded lazily.
+    """
+    lazy_oids = frozenset((
+        114,   # json
+        1082,  # date
+        1083,  # time
+        1114,  # timestamp
+        1186,  # interval
+        1700,  # numeric
+        3802,  # jsonb
+    ))
+
+    def __init__(self, *args, **kwargs):
+        super(RecordCursor, self).__init__(*args, **kwargs)
+        local = getattr(self.connection, 'string_types', {})
+        self._lazy_casters = {}
+        for oid in self.lazy_oids - _LOCAL_OIDS:
+            caster = local.get(oid) or string_types.get(oid)
+            if caster is not None:
+                self._lazy_casters[oid] = caster
+        if self._lazy_casters:
+            register_type(new_type(tuple(self._lazy_casters), 'MOMOKO_LAZY',
+                _raw), self)
+
+        self._record_description = None
+        self._record_class = None
+        self.row_factory = self._new_record
+
+    def _new_record(self, cursor):
+        description = self.description
+        if description is not self._record_description:
+            names = tuple(column[0] for column in description)
+            casters = tuple(self._lazy_casters.get(column[1])
+                for column in description)
+            self._record_class = _get_record_class(names, casters)
+            self._record_description = description
+        return self._record_class()
+
+
+def _get_record_class(names, casters):
+    """Return the record class for the given column names and typecasters,
+    creating it if it doesn't exist yet.
+    """
+    # Typecasters aren't hashable. The class holds on to its typecasters, so
+    # their ids can't be reused while it's in the cache.
+    key = (names, tuple(id(caster) if caster else None for caster in casters))
+    cls = _record_classes.get(key)
+    if cls is None or any(old is not new
+            for old, new in zip(cls._casters, casters)):
+        if len(_record_classes) >= 256:
+            _record_classes.clear()
+        cls = _record_classes[key] = _make_record_class(names, casters)
+    return cls
+
+
+def _plain_getter(slot):
+    def getter(self):
+        return getattr(self, slot)
+    return getter
+
+
+def _lazy_getter(slot, bit, caster):
+    def getter(self):
+        value = getattr(self, slot)
+        if self._pending & bit:
+            value = caster(value, None)
+            setattr(self, slot, value)
+            self._pending &= ~bit
+        return value
+    return getter
+
+
+def _make_record_class(names, casters):
+    slots = tuple('_%d' % index for index in range(len(names)))
+    cls = type('Record', (Record,), {
+        '__slots__': slots,
+        '_fields': names,
+        '_index': dict((name, index) for index, name in enumerate(names)),
+        '_casters': casters,
+    })
+
+    getters = []
+    lazy_mask = 0
+    for index, (name, caster) in enumerate(zip(names, casters)):
+        if caster is None:
+            getters.append(_plain_getter(slots[index]))
+        else:
+            bit = 1 << index
+            lazy_mask |= bit
+            getters.append(_lazy_getter(slots[index], bit, caster))
+        if _identifier(name) and not hasattr(cls, name):
+            setattr(cls, name, property(getters[-1]))
+
+    cls._getters = tuple(getters)
+    cls._setters = tuple(getattr(cls, slot).__set__ for slot in slots)
+    cls._lazy_mask = lazy_mask
+    return cls
+
+
+def _identifier(name):
+    return bool(name) and not name[0].isdigit() and \
+        name.replace('_', 'a').isalnum()
+
+
+class Record(object):
+    """Base class of the records that are returned by ``RecordCursor``.
+    """
+    __slots__ = ('_pending',)
+
+    _fields = ()
+    _index = {}
+    _casters = ()
+    _getters = ()
+    _setters = ()
+    _lazy_mask = 0
+
+    def __init__(self):
+        self._pending = self._lazy_mask
+
+    def __setitem__(self, index, value):
+        # Used by psycopg2 to fill the record
+        self._setters[index](self, value)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return tuple(self)[key]
+        if not isinstance(key, numbers.Integral):
+            key = self._index[key]
+        return self._getters[key](self)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        for getter in self._getters:
+            yield getter(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Record, tuple)):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join('%s=%r' % item
+            for item in zip(self._fields, self))
+
+    def _asdict(self):
+        """Return the record as an ordered dictionary.
+        """
+        return OrderedDict(zip(self._fields, self))
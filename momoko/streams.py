@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.streams
+    ~~~~~~~~~~~~~~
+
+    Read large objects and large ``bytea`` values in chunks, so the memory
+    that's used doesn't depend on the size of the value.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import numbers
+
+from .utils import CollectionMixin
+
+
+CHUNK_SIZE = 256 * 1024
+
+# Large objects are read with lo_get, because lo_* file descriptors only live
+# in a transaction and the lobject interface doesn't work on asynchronous
+# connections. lo_get is available since PostgreSQL 9.4.
+LO_QUERY = 'SELECT lo_get(%(oid)s, %(offset)s, %(length)s);'
+
+
+class BlobStream(CollectionMixin):
+    """Read a large object or a ``bytea`` value chunk by chunk. Every chunk
+    is a query of its own, so at most two chunks are in memory: the one that
+    is handed over and the next one, which is already read while the previous
+    one is written.
+
+    `source` is the OID of a large object or a query that selects one
+    ``bytea`` slice with the placeholders ``%(offset)s`` (counted from 0) and
+    ``%(length)s``::
+
+        SELECT substring(data FROM %(offset)s + 1 FOR %(length)s)
+        FROM files WHERE id = %(id)s;
+
+    PostgreSQL only reads the slices of a value that are needed when the
+    column isn't compressed (``ALTER TABLE files ALTER data SET STORAGE
+    EXTERNAL``), otherwise every query decompresses the value up to the
+    slice.
+
+    The chunks go to a `buffer` or to `write`:
+
+    - `buffer` is a writable buffer, e.g. a ``bytearray``, ``mmap`` or a
+      ``memoryview`` of one, which the chunks are copied into. Reading fails
+      with ``ValueError`` if the value doesn't fit.
+    - `write` is a function that gets a ``memoryview`` of every chunk and a
+      function that it calls, optionally with an exception, when it's ready
+      for the next chunk. ``response_writer`` returns one for a Tornado
+      ``RequestHandler``.
+
+    The chunks are read with separate statements, so a value that's changed
+    while it's read can come out mixed up. Only stream values that don't
+    change, or write new versions to new rows or large objects.
+
+    :param db: A ``momoko.AsyncClient`` or ``momoko.AdispClient`` instance.
+    :param source: The OID of a large object or a query for a ``bytea`` slice.
+    :param callback: The function that's called with the amount of bytes that
+                     are read, or with an exception.
+    :param parameters: A dictionary with the other parameters of the query.
+                       Optional.
+    :param buffer: A writable buffer to read the value into. Optional.
+    :param write: A function that writes the chunks. Optional.
+    :param chunk_size: The amount of bytes that's read per query.
+    :param priority: The priority lane of the queries. Optional.
+    :param deadline: The time (as returned by ``time.time()``) at which the
+                     whole value must be read. Optional.
+    :param session: A dictionary with run-time settings for the
+                    session of the connections, e.g. a ``search_path``.
+                    Optional.
+    """
+    def __init__(self, db, source, callback, parameters=None, buffer=None,
+                 write=None, chunk_size=CHUNK_SIZE, priority=None,
+                 deadline=None, session=None):
+        super(BlobStream, self).__init__(db, callback, priority, deadline,
+            session)
+        if (buffer is None) == (write is None):
+            raise ValueError('Either buffer or write is required.')
+        if isinstance(source, numbers.Integral):
+            self._query = LO_QUERY
+            self._parameters = {'oid': source}
+        else:
+            self._query = source
+            self._parameters = dict(parameters or {})
+        self._view = memoryview(buffer) if buffer is not None else None
+        self._write = write
+        self._chunk_size = chunk_size
+        self._offset = 0
+        self.position = 0
+        self._fetching = False
+        self._writing = False
+        self._ready = None
+        self._end = False
+        self._fetch()
+
+    def _fetch(self):
+        self._fetching = True
+        parameters = dict(self._parameters, offset=self._offset,
+            length=self._chunk_size)
+        self._offset += self._chunk_size
+        self._track(self._method(['execute'])(self._query, parameters,
+            callback=self._collect))
+
+    def _collect(self, cursor):
+        if self.cancelled or self._failed(cursor):
+            return
+        row = cursor.fetchone()
+        chunk = row[0] if row and row[0] is not None else b''
+        self._fetching = False
+        self._end = len(chunk) < self._chunk_size
+        self._ready = chunk
+        self._deliver()
+
+    def _deliver(self):
+        if self._writing or self._ready is None:
+            return
+        chunk, self._ready = memoryview(self._ready), None
+        if not self._end:
+            self._fetch()
+            if self.cancelled:
+                return
+        size = len(chunk)
+        if self._view is not None:
+            if self.position + size > len(self._view):
+                self._fail(ValueError('The value is larger than the buffer.'))
+                return
+            self._view[self.position:self.position + size] = chunk
+            self.position += size
+            self._written()
+        elif size:
+            self._writing = True
+            self.position += size
+            try:
+                self._write(chunk, self._written)
+            except Exception as error:
+                self._fail(error)
+        else:
+            self._written()
+
+    def _written(self, error=None):
+        if self.cancelled:
+            return
+        if error is not None:
+            self._fail(error)
+            return
+        self._writing = False
+        if self._ready is not None:
+            self._deliver()
+        elif self._end and not self._fetching and self._callback:
+            callback, self._callback = self._callback, None
+            callback(self.position)
+
+
+def response_writer(handler):
+    """Return a `write` function for ``BlobStream`` that writes the chunks to
+    the Tornado ``RequestHandler`` `handler` and reads the next chunk once the
+    previous one is flushed to the client. A slow client therefore slows down
+    reading instead of filling the output buffer::
+
+        def get(self, oid):
+            self.set_header('Content-Type', 'application/octet-stream')
+            self.db.stream_blob(int(oid), write=response_writer(self),
+                callback=lambda result: self.finish())
+    """
+    def write(chunk, callback):
+        # RequestHandler.write only accepts bytes
+        handler.write(chunk.tobytes())
+        future = handler.flush()
+        if future is None:
+            # Tornado versions before 4 don't return a Future
+            callback()
+        else:
+            future.add_done_callback(
+                lambda future: callback(future.exception()))
+    return write
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.trace
+    ~~~~~~~~~~~~
+
+    Record the lifecycle of queries as a timeline that can be loaded in
+    Chrome's ``about:tracing`` or Perfetto.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import os
+import json
+import time
+import random
+
+import psycopg2.extensions
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+POLL_STATES = {
+    psycopg2.extensions.POLL_OK: 'ok',
+    psycopg2.extensions.POLL_READ: 'read',
+    psycopg2.extensions.POLL_WRITE: 'write',
+    psycopg2.extensions.POLL_ERROR: 'error',
+}
+
+
+class Tracer(object):
+    """Collects the lifecycle events of sampled operations in the Chrome
+    trace event format.
+
+    Every sampled operation is an asynchronous ``operation`` span with the
+    nested spans ``queued`` (waiting for a connection), ``query`` (from
+    sending the query until the result is there) and ``callback``, and
+    instant events when it's checked out and for every state change in
+    ``Poller``. Making a new connection is a ``connect`` span on the thread
+    of the connection's file descriptor.
+
+    A tracer is passed to a pool as ``tracer``. To trace 1% of the queries for
+    a minute in production::
+
+        tracer = Tracer(sample_rate=0.01, active=False)
+        db = momoko.AsyncClient({'database': 'app', 'tracer': tracer})
+        tracer.start(60)
+        # ... a minute later
+        tracer.export('/var/tmp/app.trace.json')
+
+    :param sample_rate: The fraction of operations that's traced.
+    :param max_events: The maximum amount of events that's kept. Events after
+                       that are dropped, which limits the memory a forgotten
+                       tracer uses.
+    :param active: ``False`` to only start tracing when ``start`` is called.
+    """
+    def __init__(self, sample_rate=1.0, max_events=100000, active=True):
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        self._active = active
+        self._until = None
+        self._count = 0
+        self._pid = os.getpid()
+
+    def start(self, duration=None):
+        """Start tracing, optionally for `duration` seconds.
+        """
+        self._active = True
+        self._until = None if duration is None else time.time() + duration
+
+    def stop(self):
+        """Stop tracing. Operations that are already sampled are still traced
+        until they're done.
+        """
+        self._active = False
+
+    @property
+    def active(self):
+        if self._active and self._until is not None and (
+                time.time() >= self._until):
+            self._active = False
+        return self._active
+
+    def sample(self):
+        """Return a new trace id if the next operation is traced, otherwise
+        ``None``.
+        """
+        if not self.active or (self.sample_rate < 1.0 and
+                random.random() >= self.sample_rate):
+            return None
+        self._count += 1
+        return self._count
+
+    def _add(self, event):
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        event['pid'] = self._pid
+        self.events.append(event)
+
+    def _event(self, phase, trace, name, timestamp, args):
+        event = {
+            'name': name,
+            'cat': 'momoko',
+            'ph': phase,
+            'id': trace,
+            'tid': 0,
+            'ts': int((timestamp or time.time()) * 1000000),
+        }
+        if args:
+            event['args'] = args
+        self._add(event)
+
+    def begin(self, trace, name, args=None, timestamp=None):
+        """Begin the span `name` of the operation with the id `trace`.
+        """
+        self._event('b', trace, name, timestamp, args)
+
+    def end(self, trace, name, args=None, timestamp=None):
+        """End the span `name` of the operation with the id `trace`.
+        """
+        self._event('e', trace, name, timestamp, args)
+
+    def span(self, trace, name, started, args=None):
+        """Add the span `name` from `started` until now.
+        """
+        self._event('b', trace, name, started, args)
+        self._event('e', trace, name, None, None)
+
+    def instant(self, trace, name, args=None):
+        """Add the instant event `name`.
+        """
+        self._event('n', trace, name, None, args)
+
+    def poll(self, trace, state):
+        """Add a ``poll`` event with the state ``Poller`` got.
+        """
+        self._event('n', trace, 'poll', None,
+            {'state': POLL_STATES.get(state, state)})
+
+    def complete(self, name, started, tid, args=None):
+        """Add the span `name` from `started` until now on the thread `tid`,
+        which isn't tied to an operation.
+        """
+        now = time.time()
+        event = {
+            'name': name,
+            'cat': 'momoko',
+            'ph': 'X',
+            'tid': tid,
+            'ts': int(started * 1000000),
+            'dur': int((now - started) * 1000000),
+        }
+        if args:
+            event['args'] = args
+        self._add(event)
+
+    def clear(self):
+        """Remove all events.
+        """
+        self.events = []
+        self.dropped = 0
+
+    def export(self, file):
+        """Write the events as a Chrome trace JSON object.
+
+        :param file: A file name or a file object.
+        """
+        trace = {
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'dropped': self.dropped},
+        }
+        if isinstance(file, basestring):
+            with open(file, 'w') as f:
+                json.dump(trace, f)
+        else:
+            json.dump(trace, file)
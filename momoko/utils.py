@@ -10,25 +10,91 @@
 """
 
 
+import json
 import functools
+from decimal import Decimal
 
 import psycopg2
+import psycopg2.extras
 import psycopg2.extensions
-from tornado.ioloop import IOLoop
+
+from .loops import READ, WRITE, Future, adapt, current_ioloop
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+class DeadlineExceeded(Exception):
+    """Passed to the callback of an operation, or of a chain, batch, graph or
+    pipeline, that didn't finish before its deadline.
+    """
 
 
 class CollectionMixin(object):
 
     methods = ('execute','callproc',)
 
-    def __init__(self, db, callback):
+    def __init__(self, db, callback, priority=None, deadline=None,
+                 session=None):
         self._db = db
         self._callback = callback
+        self._priority = priority
+        self._deadline = deadline
+        self._session = session
+        self._operations = []
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel all running queries and don't start new ones. The callback
+        won't be executed.
+        """
+        self.cancelled = True
+        self._callback = None
+        for operation in self._operations:
+            operation.cancel()
+
+    def _track(self, operation):
+        # None when the query couldn't be started
+        if operation is not None:
+            self._operations.append(operation)
+
+    def _fail(self, error):
+        """Cancel all running queries and pass the error on to the callback.
+        """
+        callback = self._callback
+        self.cancel()
+        if callback:
+            callback(error)
+
+    def _failed(self, cursor):
+        # A sub-query that failed or ran out of time aborts the whole
+        # collection
+        if isinstance(cursor, Exception):
+            self._fail(cursor)
+            return True
+        return False
 
     def _method(self, query):
+        """Return a function that starts `query` on the pool of the client and
+        returns the ``Operation``. The pool is used directly, because the
+        functions of an ``AdispClient`` only return a caller for adisp.
+        """
         method = query.pop(0) if query[0] in self.methods else 'execute'
-        return getattr(self._db, method)
-        
+        default = () if method == 'execute' else None
+
+        def start(name, parameters=default, callback=None, args={}):
+            try:
+                return self._db._pool.new_cursor(method, (name, parameters),
+                    callback, cursor_args=args, priority=self._priority,
+                    deadline=self._deadline, session=self._session)
+            except Exception as error:
+                # E.g. a PoolOverloadError. Queries are often started from the
+                # callback of the previous one, where the pool would get it.
+                self._fail(error)
+        return start
+
     @staticmethod
     def _cursor_args(query):
         retval = query.pop() if isinstance(query[-1], dict) else {}
@@ -56,16 +122,28 @@ class QueryChain(CollectionMixin):
     :param queries: A tuple or with all the queries.
     :param callback: The function that needs to be executed once all the
                      queries are finished.
-    :return: A list with the resulting cursors is passed on to the callback.
+    :param priority: The priority lane of the queries. Optional.
+    :param deadline: The time (as returned by ``time.time()``) at which all
+                     queries must be finished. Optional.
+    :param session: A dictionary with run-time settings for the
+                    session of the connections, e.g. a ``search_path``.
+                    Optional.
+    :return: A list with the resulting cursors is passed on to the callback,
+             or the exception if a query failed, e.g. ``DeadlineExceeded`` if
+             the deadline passed.
     """
-    def __init__(self, db, queries, callback):
-        super(QueryChain, self).__init__(db, callback)
+    def __init__(self, db, queries, callback, priority=None, deadline=None,
+                 session=None):
+        super(QueryChain, self).__init__(db, callback, priority, deadline,
+            session)
         self._cursors = []
         self._queries = list(queries)
         self._queries.reverse()
         self._collect(None)
 
     def _collect(self, cursor):
+        if self.cancelled or self._failed(cursor):
+            return
         if cursor is not None:
             self._cursors.append(cursor)
         if not self._queries:
@@ -76,7 +154,8 @@ class QueryChain(CollectionMixin):
         if isinstance(query, basestring):
             query = [query]
         cargs = self._cursor_args(query)
-        self._method(query)(*query, callback=self._collect, args=cargs)
+        self._track(self._method(query)(*query, callback=self._collect,
+            args=cargs))
 
 
 class BatchQuery(CollectionMixin):
@@ -101,11 +180,21 @@ class BatchQuery(CollectionMixin):
     :param queries: A dictionary with all the queries.
     :param callback: The function that needs to be executed once all the
                      queries are finished.
+    :param priority: The priority lane of the queries. Optional.
+    :param deadline: The time (as returned by ``time.time()``) at which all
+                     queries must be finished. Optional.
+    :param session: A dictionary with run-time settings for the
+                    session of the connections, e.g. a ``search_path``.
+                    Optional.
     :return: A dictionary with the same keys as the given queries with the
-             resulting cursors as values is passed on to the callback.
+             resulting cursors as values is passed on to the callback, or the
+             exception if a query failed, e.g. ``DeadlineExceeded`` if the
+             deadline passed.
     """
-    def __init__(self, db, queries, callback):
-        super(BatchQuery, self).__init__(db, callback)
+    def __init__(self, db, queries, callback, priority=None, deadline=None,
+                 session=None):
+        super(BatchQuery, self).__init__(db, callback, priority, deadline,
+            session)
         self._queries = {}
         self._args = {}
         self._size = len(queries)
@@ -118,41 +207,434 @@ class BatchQuery(CollectionMixin):
             self._queries[key] = (query, cargs,)
             
         for query, cargs in list(self._queries.values()):
-            self._method(query)(*query, args=cargs)
+            if self.cancelled:
+                break
+            self._track(self._method(query)(*query, args=cargs))
+        if not self._size and self._callback:
+            self._callback(self._args)
 
     def _collect(self, key, cursor):
+        if self.cancelled or self._failed(cursor):
+            return
         self._size = self._size - 1
         self._args[key] = cursor
         if not self._size and self._callback:
             self._callback(self._args)
 
 
+class QueryGraph(CollectionMixin):
+    """Run queries that depend on each other as soon as their dependencies
+    are finished.
+
+    Queries without dependencies look the same as in ``BatchQuery``. A query
+    with dependencies is a dictionary with a ``depends`` list and a ``query``.
+    The query can be a callable that gets a dictionary with the cursors of
+    the dependencies and returns the query::
+
+        {
+            'user': ['SELECT id FROM users WHERE name = %s;', ('frank',)],
+            'posts': {
+                'depends': ('user',),
+                'query': lambda results: [
+                    'SELECT title FROM posts WHERE user_id = %s;',
+                    (results['user'].fetchone()[0],)]
+            },
+            'count': 'SELECT count(*) FROM posts;'
+        }
+
+    The cursors are scrolled back to the first row before they are passed on
+    to a callable or the callback, so every dependent query sees all rows.
+
+    If a query fails, or a callable raises an exception, the running queries
+    are cancelled and the exception is passed on to the callback.
+
+    :param db: A ``momoko.AsyncClient`` or ``momoko.AdispClient`` instance.
+    :param queries: A dictionary with all the queries.
+    :param callback: The function that needs to be executed once all the
+                     queries are finished.
+    :param concurrency: The maximum amount of queries that run at the same
+                        time. Unlimited by default.
+    :param priority: The priority lane of the queries. Optional.
+    :param deadline: The time (as returned by ``time.time()``) at which all
+                     queries must be finished. Optional.
+    :param session: A dictionary with run-time settings for the
+                    session of the connections, e.g. a ``search_path``.
+                    Optional.
+    :return: A dictionary with the same keys as the given queries with the
+             resulting cursors as values is passed on to the callback.
+    """
+    def __init__(self, db, queries, callback, concurrency=None, priority=None,
+                 deadline=None, session=None):
+        super(QueryGraph, self).__init__(db, callback, priority, deadline,
+            session)
+        self._concurrency = concurrency
+        self._queries = {}
+        self._depends = {}
+        self._dependents = dict((key, []) for key in queries)
+        self._cursors = {}
+        self._ready = []
+        self._running = 0
+
+        for key, query in queries.items():
+            depends = set()
+            if isinstance(query, dict):
+                # A dependency that's listed twice would start the query twice
+                depends = set(query.get('depends', ()))
+                query = query['query']
+            for name in depends:
+                if name not in queries:
+                    raise ValueError('query %r depends on unknown query %r'
+                        % (key, name))
+                self._dependents[name].append(key)
+            self._queries[key] = query
+            self._depends[key] = depends
+        self._check_cycles()
+
+        self._ready = [key for key, depends in self._depends.items()
+            if not depends]
+        self._run()
+
+    def _check_cycles(self):
+        waiting = dict((key, len(depends))
+            for key, depends in self._depends.items())
+        ready = [key for key, count in waiting.items() if not count]
+        while ready:
+            key = ready.pop()
+            del waiting[key]
+            for dependent in self._dependents[key]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    ready.append(dependent)
+        if waiting:
+            raise ValueError('circular dependencies between queries: %s'
+                % ', '.join(sorted(map(repr, waiting))))
+
+    def _run(self):
+        while self._ready and not self.cancelled and (
+                self._concurrency is None or
+                self._running < self._concurrency):
+            key = self._ready.pop(0)
+            query = self._queries[key]
+            try:
+                if callable(query):
+                    query = query(self._results(self._depends[key]))
+            except Exception as error:
+                self._fail(error)
+                return
+            if isinstance(query, basestring):
+                query = [query, ()]
+            query = list(query)
+            method = self._method(query)
+            cargs = self._cursor_args(query)
+            self._running += 1
+            self._track(method(*query,
+                callback=functools.partial(self._collect, key), args=cargs))
+
+        if not self._running and not self._ready and not self.cancelled:
+            if self._callback:
+                self._callback(self._results(self._cursors))
+
+    def _results(self, keys):
+        results = {}
+        for key in keys:
+            cursor = self._cursors[key]
+            if cursor.description is not None:
+                cursor.scroll(0, mode='absolute')
+            results[key] = cursor
+        return results
+
+    def _collect(self, key, cursor):
+        self._running -= 1
+        if self.cancelled:
+            return
+        if isinstance(cursor, Exception):
+            self._fail(cursor)
+            return
+        self._cursors[key] = cursor
+        for dependent in self._dependents[key]:
+            depends = self._depends[dependent]
+            if all(name in self._cursors for name in depends):
+                self._ready.append(dependent)
+        self._run()
+
+
+class QueryPipeline(CollectionMixin):
+    """Run several independent queries on one connection in one round trip.
+
+    psycopg2 can't have more than one query in flight on a connection and only
+    returns the result of the last statement in a string, so the queries are
+    combined into a single statement. Every query becomes a common table
+    expression and its rows are aggregated into a JSON array::
+
+        WITH "q0" AS (query0), "q1" AS (query1)
+        SELECT (SELECT json_agg("q0") FROM "q0"),
+               (SELECT json_agg("q1") FROM "q1");
+
+    This has some consequences:
+
+    - Only queries that return rows can be used (``SELECT``, ``VALUES`` and
+      ``INSERT``, ``UPDATE`` or ``DELETE`` with ``RETURNING``).
+    - All queries see the same snapshot of the database, so a query can't see
+      the changes of another query in the pipeline.
+    - Values are converted to JSON and back, so not all of them are returned
+      as the same type as with ``execute``. Numbers with a fraction
+      (``numeric``, ``real`` and ``double precision``) are returned as
+      ``Decimal``, so ``numeric`` values keep their precision. Dates, times,
+      intervals, ``bytea`` (in hex format) and other types without a JSON
+      equivalent are returned as strings.
+    - If one query fails, they all fail.
+    - PostgreSQL 9.3 or newer is needed.
+
+    The queries are given as a list/tuple, like with ``QueryChain``, or as a
+    dictionary, like with ``BatchQuery``::
+
+        {
+            'user': ['SELECT id, name FROM users WHERE id = %s;', (1,)],
+            'count': 'SELECT count(*) FROM users;'
+        }
+
+    :param db: A ``momoko.AsyncClient`` or ``momoko.AdispClient`` instance.
+    :param queries: A list/tuple or a dictionary with all the queries.
+    :param callback: The function that needs to be executed once all the
+                     queries are finished.
+    :param priority: The priority lane of the queries. Optional.
+    :param deadline: The time (as returned by ``time.time()``) at which the
+                     pipeline is cancelled. Optional.
+    :param session: A dictionary with run-time settings for the
+                    session of the connections, e.g. a ``search_path``.
+                    Optional.
+    :return: A list or dictionary (the same as `queries`) with a
+             ``PipelineResult`` per query is passed on to the callback.
+    """
+    def __init__(self, db, queries, callback, priority=None, deadline=None,
+                 session=None):
+        super(QueryPipeline, self).__init__(db, callback, priority,
+            deadline, session)
+        if isinstance(queries, dict):
+            self._keys = list(queries.keys())
+            queries = [queries[key] for key in self._keys]
+        else:
+            self._keys = None
+
+        statements = []
+        for query in queries:
+            if isinstance(query, basestring):
+                query = [query]
+            statements.append((query[0], query[1] if len(query) > 1 else ()))
+
+        self._track(db._pool.new_cursor('execute_pipeline', (statements,),
+            self._collect, cursor_args={'cursor_factory': PipelineCursor},
+            priority=priority, deadline=deadline, session=session))
+
+    def _collect(self, cursor):
+        if isinstance(cursor, Exception):
+            results = cursor
+        else:
+            results = [PipelineResult(rows) for rows in cursor.fetchone()]
+            if self._keys is not None:
+                results = dict(zip(self._keys, results))
+        if self._callback:
+            self._callback(results)
+
+
+class PipelineCursor(psycopg2.extensions.cursor):
+    """A cursor that can combine several queries into one statement. Used by
+    ``QueryPipeline``.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PipelineCursor, self).__init__(*args, **kwargs)
+        # Typecasters are picked when the result arrives, so this must be done
+        # before executing. Rows are kept as key/value pairs, because columns
+        # can have the same name (e.g. "?column?").
+        loads = functools.partial(json.loads, object_pairs_hook=_Pairs,
+            parse_float=Decimal)
+        psycopg2.extras.register_json(self, loads=loads, oid=114,
+            array_oid=199)
+
+    def execute_pipeline(self, statements):
+        """Execute a list of ``(operation, parameters)`` tuples as a single
+        statement.
+        """
+        encoding = psycopg2.extensions.encodings[self.connection.encoding]
+        ctes = []
+        selects = []
+        for index, (operation, parameters) in enumerate(statements):
+            operation = self.mogrify(operation, parameters)
+            if not isinstance(operation, str):
+                operation = operation.decode(encoding)
+            # The newline ends a -- comment at the end of the query
+            ctes.append('"q%d" AS (%s\n)' % (index,
+                operation.strip().rstrip(';')))
+            selects.append('(SELECT json_agg("q%d") FROM "q%d")' % (index, index))
+        self.execute('WITH %s SELECT %s;' % (', '.join(ctes), ', '.join(selects)))
+
+
+class _Pairs(list):
+    """The key/value pairs of a JSON object.
+    """
+
+
+def _objects(value):
+    # JSON objects in the values, e.g. of json columns, become dictionaries
+    if isinstance(value, _Pairs):
+        return dict((key, _objects(item)) for key, item in value)
+    if isinstance(value, list):
+        return [_objects(item) for item in value]
+    return value
+
+
+class FetchedRows(object):
+    """Rows that are fetched already, with the fetch functions of a cursor.
+
+    :param rows: A list with the rows.
+    """
+    def __init__(self, rows):
+        self.rowcount = len(rows)
+        self._rows = rows
+        self._position = 0
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+
+class PipelineResult(FetchedRows):
+    """The result of one query in a ``QueryPipeline``. It provides the fetch
+    functions of a cursor.
+
+    :param rows: A list with the rows as lists of ``(column, value)`` pairs,
+                 or ``None`` if the query didn't return any rows.
+    """
+    def __init__(self, rows):
+        rows = rows or []
+        self.columns = [column for column, value in rows[0]] if rows else []
+        super(PipelineResult, self).__init__([tuple(_objects(value)
+            for column, value in row) for row in rows])
+
+
+class FetchedCursor(FetchedRows):
+    """The result of a cursor whose rows are fetched on the thread that ran
+    the query, so the connection can be used by another thread once it's
+    back in the pool. It has the fetch functions and the most used
+    attributes of a cursor. Used by ``ThreadedClient``.
+
+    :param cursor: A cursor that executed a query.
+    """
+    def __init__(self, cursor):
+        # Named cursors only get a description and rowcount by fetching
+        if cursor.name is not None or cursor.description is not None:
+            rows = cursor.fetchall()
+        else:
+            rows = []
+        super(FetchedCursor, self).__init__(rows)
+        self.description = cursor.description
+        if cursor.name is None:
+            self.rowcount = cursor.rowcount
+        self.statusmessage = cursor.statusmessage
+        self.query = cursor.query
+
+
+class PollCounts(object):
+    """Counts what a ``Poller`` does for one operation: the calls to
+    ``poll``, the flips between ``POLL_READ`` and ``POLL_WRITE`` and the
+    handlers it registered with the IOLoop.
+    """
+    __slots__ = ('connection', 'polls', 'flips', 'registrations', 'state')
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.polls = 0
+        self.flips = 0
+        self.registrations = 0
+        self.state = None
+
+
 class Poller(object):
     """A poller that polls the PostgreSQL connection and calls the callbacks
     when the connection state is ``POLL_OK``.
 
     :param connection: The connection that needs to be polled.
     :param callbacks: A tuple/list of callbacks.
+    :param ioloop: An instance of Tornado's IOLoop or an asyncio event loop.
+    :param errback: A callable that is executed with the exception when
+                    polling fails. The exception is raised if it's not
+                    provided.
+    :param trace: A callable that gets the state after every poll.
+    :param counts: A ``PollCounts`` instance that's updated after every poll.
     """
     # TODO: Accept new argument "is_connection"
-    def __init__(self, connection, callbacks=(), ioloop=None):
-        self._ioloop = ioloop or IOLoop.instance()
+    def __init__(self, connection, callbacks=(), ioloop=None, errback=None,
+                 trace=None, counts=None):
+        self._ioloop = adapt(ioloop) if ioloop else current_ioloop()
         self._connection = connection
         self._callbacks = callbacks
-
-        self._update_handler()
-
-    def _update_handler(self):
-        state = self._connection.poll()
+        self._errback = errback
+        self._trace = trace
+        self._counts = counts
+
+        self._update_handler(True)
+
+    def _update_handler(self, first=False):
+        if self._counts is not None:
+            self._counts.polls += 1
+        try:
+            state = self._connection.poll()
+        except (psycopg2.Warning, psycopg2.Error) as error:
+            if self._trace is not None:
+                self._trace(psycopg2.extensions.POLL_ERROR)
+            if self._errback is None:
+                raise
+            if first:
+                self._ioloop.add_callback(functools.partial(self._errback,
+                    error))
+            else:
+                self._errback(error)
+            return
+        if self._trace is not None:
+            self._trace(state)
         if state == psycopg2.extensions.POLL_OK:
-            for callback in self._callbacks:
-                callback()
+            # A result that's there right away is passed on in the next IOLoop
+            # iteration, otherwise a callback that starts a new query that
+            # finishes right away would recurse without bounds
+            if first:
+                self._ioloop.add_callback(self._run_callbacks)
+            else:
+                self._run_callbacks()
         elif state == psycopg2.extensions.POLL_READ:
+            self._count(state)
             self._ioloop.add_handler(self._connection.fileno(),
-                self._io_callback, IOLoop.READ)
+                self._io_callback, READ)
         elif state == psycopg2.extensions.POLL_WRITE:
+            self._count(state)
             self._ioloop.add_handler(self._connection.fileno(),
-                self._io_callback, IOLoop.WRITE)
+                self._io_callback, WRITE)
+
+    def _count(self, state):
+        counts = self._counts
+        if counts is not None:
+            counts.registrations += 1
+            if counts.state is not None and counts.state != state:
+                counts.flips += 1
+            counts.state = state
+
+    def _run_callbacks(self):
+        for callback in self._callbacks:
+            callback()
 
     def _io_callback(self, *args):
         self._ioloop.remove_handler(self._connection.fileno())
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 import sys
+import time
 import unittest
 
+import psycopg2
 import tornado.ioloop
 import tornado.testing
 import momoko
@@ -76,5 +78,166 @@ class AdispClientTest(tornado.testing.AsyncTestCase):
             self.assertEqual(cursor.fetchall(), expected[index])
 
 
+    def test_failed_chain_and_batch(self):
+        """Test that a failing query is raised once by a chain and a batch.
+        """
+        @momoko.process
+        def run():
+            errors = []
+            try:
+                yield self.db.chain(('SELECT 1;', 'SELECT * FROM nothing;',
+                    'SELECT 2;'))
+            except psycopg2.ProgrammingError as error:
+                errors.append(error)
+            try:
+                yield self.db.batch({'good': 'SELECT 1;',
+                    'bad': 'SELECT * FROM nothing;'})
+            except psycopg2.ProgrammingError as error:
+                errors.append(error)
+            cursors = yield self.db.batch({})
+            self.stop((errors, cursors))
+
+        run()
+        errors, cursors = self.wait()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(cursors, {})
+
+    def test_deadline_chain(self):
+        """Test that an expired deadline is raised by a chain.
+        """
+        @momoko.process
+        def run():
+            try:
+                yield self.db.chain(('SELECT pg_sleep(10);', 'SELECT 1;'),
+                    deadline=time.time() + 0.1)
+            except momoko.DeadlineExceeded as error:
+                self.stop(error)
+
+        run()
+        self.assertTrue(isinstance(self.wait(timeout=2),
+            momoko.DeadlineExceeded))
+
+    def test_caller_error(self):
+        """Test that an exception a caller raises right away is raised at the
+        ``yield``, also after the process was resumed.
+        """
+        db = momoko.AdispClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'max_queue': 1,
+            'ioloop': self.io_loop
+        })
+        errors = []
+
+        def sleep(seconds, callback):
+            self.io_loop.add_timeout(time.time() + seconds,
+                lambda: callback(None))
+
+        @momoko.process
+        def run():
+            yield db.execute('SELECT 1;')
+            momoko.AsyncClient.execute(db, 'SELECT pg_sleep(0.1);')
+            try:
+                # The first query is queued, the second one is rejected
+                yield [db.execute('SELECT 2;'), db.execute('SELECT 3;')]
+            except momoko.PoolOverloadError as error:
+                errors.append(error)
+            # The callback of the queued query is ignored
+            yield momoko.async(sleep)(0.3)
+            cursor = yield db.execute('SELECT 4;')
+            self.stop(cursor.fetchall())
+
+        run()
+        self.assertEqual(self.wait(timeout=2), [(4,)])
+        db.close()
+        self.assertEqual(len(errors), 1)
+
+    def test_graph_query(self):
+        """Test executing a query graph.
+        """
+        calls = []
+
+        def posts(results):
+            calls.append(results['user'].fetchone()[0])
+            return ['SELECT %s * 2;', (calls[-1],)]
+
+        input = {
+            'user': 'SELECT 21;',
+            # A dependency that's listed twice still runs the query once
+            'posts': {'depends': ('user', 'user'), 'query': posts},
+        }
+
+        @momoko.process
+        def run():
+            results = yield self.db.graph(input)
+            self.stop(results)
+
+        run()
+        results = self.wait()
+        self.assertEqual(results['posts'].fetchall(), [(42,)])
+        self.assertEqual(calls, [21])
+
+    def test_stream_blob(self):
+        """Test streaming a large object into a buffer.
+        """
+        data = bytes(bytearray(i % 251 for i in range(1000)))
+        buffer = bytearray(1000)
+
+        @momoko.process
+        def run():
+            cursor = yield self.db.execute('SELECT lo_from_bytea(0, %s);',
+                (psycopg2.Binary(data),))
+            oid = cursor.fetchone()[0]
+            size = yield self.db.stream_blob(oid, buffer=buffer,
+                chunk_size=300)
+            yield self.db.execute('SELECT lo_unlink(%s);', (oid,))
+            self.stop(size)
+
+        run()
+        self.assertEqual(self.wait(), 1000)
+        self.assertEqual(bytes(buffer), data)
+
+    def test_process_error(self):
+        """Test that an exception in a resumed process is logged and doesn't
+        break the pool.
+        """
+        # With one connection the query of run() is done after the one of
+        # fail()
+        db = momoko.AdispClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+
+        @momoko.process
+        def fail():
+            yield db.execute('SELECT 1;')
+            raise ValueError('process failed')
+
+        @momoko.process
+        def run():
+            cursor = yield db.execute('SELECT 42;')
+            self.stop(cursor.fetchone())
+
+        with tornado.testing.ExpectLog('', 'Exception in fail'):
+            for i in range(3):
+                fail()
+                run()
+                self.assertEqual(self.wait(), (42,))
+        self.assertEqual(db._pool._free, db._pool._pool)
+        db.close()
+
 if __name__ == '__main__':
     unittest.main()
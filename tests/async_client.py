@@ -1,14 +1,38 @@
 #!/usr/bin/env python
 
+import io
 import sys
+import json
 import unittest
 
+import array
+import datetime
+import time
+import threading
+import functools
+from decimal import Decimal
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+import psycopg2.sql
+import psycopg2.extensions
 import tornado.ioloop
 import tornado.testing
 import momoko
+from momoko.results import ProcessDecoder, ColumnarCursor, RecordCursor
+from momoko.recorder import Recorder, Replayer, read_operations
+from momoko.trace import Tracer
 
 import settings
 
+try:
+    long
+except NameError:
+    long = int # Python 3
+
 
 class AsyncClientTest(tornado.testing.AsyncTestCase):
     """``AsyncClient`` tests.
@@ -75,6 +99,823 @@ class AsyncClientTest(tornado.testing.AsyncTestCase):
         for index, cursor in enumerate(cursors):
             self.assertEqual(cursor.fetchall(), expected[index])
 
+    def test_graph_query(self):
+        """Test executing queries that depend on each other.
+        """
+        input = {
+            'a': 'SELECT 2;',
+            'b': ['SELECT %s;', (3,)],
+            'c': {
+                'depends': ('a', 'b'),
+                'query': lambda results: ['SELECT %s * %s;', (
+                    results['a'].fetchone()[0], results['b'].fetchone()[0])]
+            },
+            'd': {
+                'depends': ('a', 'c'),
+                'query': lambda results: ['SELECT %s + %s;', (
+                    results['a'].fetchone()[0], results['c'].fetchone()[0])]
+            }
+        }
+        expected = {'a': [(2,)], 'b': [(3,)], 'c': [(6,)], 'd': [(8,)]}
+
+        self.db.graph(input, callback=self.stop, concurrency=1)
+        cursors = self.wait()
+
+        for key, cursor in cursors.items():
+            self.assertEqual(cursor.fetchall(), expected[key])
+
+    def test_graph_cycle(self):
+        """Test that circular dependencies are rejected.
+        """
+        input = {
+            'a': {'depends': ('b',), 'query': 'SELECT 1;'},
+            'b': {'depends': ('a',), 'query': 'SELECT 2;'}
+        }
+        self.assertRaises(ValueError, self.db.graph, input)
+
+    def test_pipeline_query(self):
+        """Test executing a pipeline of queries on one connection.
+        """
+        input = {
+            'query1': ['SELECT 42 AS a, 12 AS b, %s AS c;', (23,)],
+            'query2': 'SELECT i FROM generate_series(1, 3) AS i;',
+            'query3': 'SELECT 1 WHERE false;',
+            'query4': 'SELECT 1, 2, 3, 4, 5;',
+            'query5': ['SELECT %s::numeric, %s::json;',
+                ('12345678901234567890.123456789', '{"a": [1, {"b": 2}]}')],
+            'query6': 'SELECT 6 -- a comment at the end'
+        }
+        expected = {
+            'query1': [(42, 12, 23)],
+            'query2': [(1,), (2,), (3,)],
+            'query3': [],
+            'query4': [(1, 2, 3, 4, 5)],
+            'query5': [(Decimal('12345678901234567890.123456789'),
+                {'a': [1, {'b': 2}]})],
+            'query6': [(6,)]
+        }
+
+        self.db.pipeline(input, callback=self.stop)
+        results = self.wait()
+
+        for key, result in results.items():
+            self.assertEqual(result.fetchall(), expected[key])
+        self.assertEqual(results['query1'].columns, ['a', 'b', 'c'])
+        self.assertEqual(results['query4'].columns, ['?column?'] * 5)
+
+    def test_stream_blob(self):
+        """Test streaming large objects and bytea values in chunks.
+        """
+        data = bytes(bytearray(i % 251 for i in range(1000)))
+        self.db.execute('SELECT lo_from_bytea(0, %s);',
+            (psycopg2.Binary(data),), callback=self.stop)
+        oid = self.wait().fetchone()[0]
+
+        buffer = bytearray(1200)
+        self.db.stream_blob(oid, buffer=buffer, chunk_size=64,
+            callback=self.stop)
+        self.assertEqual(self.wait(), 1000)
+        self.assertEqual(bytes(buffer[:1000]), data)
+
+        # The next chunk is read while the previous one is written
+        chunks = []
+        def write(chunk, callback):
+            chunks.append(chunk.tobytes())
+            self.io_loop.add_callback(callback)
+        self.db.stream_blob(
+            'SELECT substring(%(data)s FROM %(offset)s + 1 FOR %(length)s);',
+            {'data': psycopg2.Binary(data)}, write=write, chunk_size=100,
+            callback=self.stop)
+        self.assertEqual(self.wait(), 1000)
+        self.assertEqual([len(chunk) for chunk in chunks], [100] * 10)
+        self.assertEqual(b''.join(chunks), data)
+
+        self.db.stream_blob(oid, buffer=bytearray(999), chunk_size=100,
+            callback=self.stop)
+        self.assertTrue(isinstance(self.wait(), ValueError))
+
+        self.db.execute('SELECT lo_unlink(%s);', (oid,), callback=self.stop)
+        self.wait()
+
+    def test_on_connect(self):
+        """Test the setup of new connections.
+        """
+        def register_point(conn, oid, array_oid):
+            point = psycopg2.extensions.new_type((oid,), 'POINT',
+                lambda value, cursor: value and tuple(
+                    float(i) for i in value[1:-1].split(',')))
+            psycopg2.extensions.register_type(point, conn)
+
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 2,
+            'max_conn': 2,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'on_connect': [['SET application_name = %s;', ('momoko',)]],
+            'typecasters': [('point', register_point)],
+            'lazy': True
+        })
+        fetched = []
+        oids_fetched = db._pool._oids_fetched
+        db._pool._oids_fetched = lambda cursor, callback: (
+            fetched.append(cursor), oids_fetched(cursor, callback))
+        db.warmup(callback=self.stop)
+        self.assertEqual(self.wait(), 2)
+        # The OIDs are fetched once, the other connection waits for them
+        self.assertEqual(len(fetched), 1)
+
+        db.batch({
+            'query1': 'SELECT current_setting(\'application_name\'), '
+                'point(1, 2);',
+            'query2': 'SELECT current_setting(\'application_name\'), '
+                'point(3, 4);'
+        }, callback=self.stop)
+        cursors = self.wait()
+
+        self.assertEqual(cursors['query1'].fetchall(), [('momoko', (1.0, 2.0))])
+        self.assertEqual(cursors['query2'].fetchall(), [('momoko', (3.0, 4.0))])
+        db.close()
+        self.assertEqual(db._pool._oids, {'point': (600, 1017)})
+
+    def test_session(self):
+        """Test that connections with the right session settings are used.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 2,
+            'max_conn': 2,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+        session = {'search_path': 'pg_catalog, public'}
+        results = []
+        # Both connections must be there before the first query
+        db.warmup(callback=self.stop)
+        self.wait()
+
+        def show(cursor):
+            results.append(cursor.fetchone()[0])
+            self.stop()
+
+        for kwargs in ({'session': session}, {}, {'session': session}):
+            db.execute('SHOW search_path;', callback=show, **kwargs)
+            self.wait()
+        db.callproc('current_setting', ('search_path',), callback=show,
+            session={'search_path': 'public'})
+        self.wait()
+        db.close()
+
+        self.assertEqual(results, ['pg_catalog, public', '"$user", public',
+            'pg_catalog, public', 'public'])
+        self.assertEqual(db.stats.session_changes, 2)
+
+    def test_transaction_pooling(self):
+        """Test that session settings are local to the transaction with
+        ``transaction_pooling``.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'transaction_pooling': True
+        })
+        results = []
+
+        def show(cursor):
+            results.append(cursor.fetchone()[0])
+            self.stop()
+
+        db.execute('SHOW search_path;', callback=show,
+            session={'search_path': 'public'})
+        self.wait()
+        db.callproc('current_setting', ('search_path',), callback=show,
+            session={'search_path': 'pg_catalog'})
+        self.wait()
+        db.execute('SHOW search_path;', callback=show)
+        self.wait()
+        db.callproc('make_interval', {'days': 2, 'hours': 3}, callback=show,
+            deadline=time.time() + 1)
+        self.wait()
+        db.close()
+
+        self.assertEqual(results, ['public', 'pg_catalog', '"$user", public',
+            datetime.timedelta(days=2, hours=3)])
+        self.assertRaises(ValueError, momoko.AsyncClient, {
+            'on_connect': 'SET search_path = public;',
+            'transaction_pooling': True
+        })
+
+    def test_record_replay(self):
+        """Test that a recorded workload can be replayed.
+        """
+        workload = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        recorder = Recorder(workload, redact=True)
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'recorder': recorder
+        })
+        db.execute('SELECT %s, %s;', (42, 'secret'), callback=self.stop)
+        self.wait()
+        db.callproc('abs', (-1,), callback=self.stop)
+        self.wait()
+        db.execute('SELECT 1/0;', callback=self.stop)
+        self.wait()
+        db._pool.new_cursor('executemany', ('SELECT %s;', [(1,), ('secret',)]),
+            callback=self.stop)
+        self.wait()
+        self.assertNotIn('secret', workload.getvalue())
+
+        workload.seek(0)
+        operations = list(read_operations(workload))
+        self.assertEqual([operation[1:] for operation in operations], [
+            ('execute', 'SELECT %s, %s;', [0, ''], 'normal'),
+            ('callproc', 'abs', [0], 'normal'),
+            ('execute', 'SELECT 1/0;', [], 'normal'),
+            ('executemany', 'SELECT %s;', [[0], ['']], 'normal')])
+
+        db._pool.recorder = None
+        functions = []
+        new_cursor = db._pool.new_cursor
+        def record_function(function, *args, **kwargs):
+            functions.append(function)
+            return new_cursor(function, *args, **kwargs)
+        db._pool.new_cursor = record_function
+        workload.seek(0)
+        Replayer(db, workload, speed=100, callback=self.stop,
+            ioloop=self.io_loop).start()
+        result = self.wait()
+        db.close()
+        self.assertEqual(functions,
+            ['execute', 'callproc', 'execute', 'executemany'])
+        self.assertEqual(result['operations'], 4)
+        # Asynchronous connections can't executemany, as when recorded
+        self.assertEqual(result['errors'], 2)
+        self.assertEqual(len(result['latencies']), 2)
+
+    def test_trace(self):
+        """Test that the lifecycle of sampled operations is traced.
+        """
+        tracer = Tracer()
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 0,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'tracer': tracer
+        })
+        db.execute('SELECT 1;', callback=self.stop)
+        self.wait()
+        tracer.stop()
+        db.execute('SELECT 1;', callback=self.stop)
+        self.wait()
+        db.close()
+
+        trace = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        tracer.export(trace)
+        events = json.loads(trace.getvalue())['traceEvents']
+        names = [(event['name'], event['ph']) for event in events]
+        self.assertIn(('connect', 'X'), names)
+        self.assertEqual(names.count(('operation', 'b')), 1)
+        self.assertEqual(names.count(('operation', 'e')), 1)
+        for name in ('queued', 'query', 'callback'):
+            self.assertIn((name, 'b'), names)
+            self.assertIn((name, 'e'), names)
+        self.assertIn(('checked out', 'n'), names)
+        self.assertIn({'state': 'ok'}, [event.get('args') for event in events
+            if event['name'] == 'poll'])
+
+        tracer = Tracer(sample_rate=0)
+        self.assertEqual(tracer.sample(), None)
+
+    def test_profile_polls(self):
+        """Test that polls and handler registrations are counted.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'profile_polls': True
+        })
+        db.execute('SELECT 1;', callback=self.stop)
+        self.wait()
+        db.execute('SELECT pg_sleep(0.01);', callback=self.stop)
+        self.wait()
+        stats = db.stats.as_dict()
+        db.close()
+
+        # SELECT 1 can be done on the first poll, pg_sleep isn't
+        self.assertEqual(stats['profiled_queries'], 2)
+        self.assertTrue(stats['polls'] >= 3)
+        self.assertTrue(stats['handler_registrations'] >= 1)
+        self.assertEqual(stats['polls'] - stats['handler_registrations'], 2)
+        connection, = stats['poll_connections'].values()
+        self.assertEqual(connection['queries'], 2)
+        self.assertEqual(len(stats['poll_outliers']), 2)
+
+    def test_poller_first_poll(self):
+        """Test that a result or error that's there on the first poll is
+        passed on in the next IOLoop iteration.
+        """
+        connection = psycopg2.connect(host=settings.host, port=settings.port,
+            database=settings.database, user=settings.user,
+            password=settings.password, async_=1)
+        momoko.utils.Poller(connection, (self.stop,), ioloop=self.io_loop)
+        self.wait()
+
+        calls = []
+        momoko.utils.Poller(connection, (lambda: calls.append(True),),
+            ioloop=self.io_loop)
+        self.assertEqual(calls, [])
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual(calls, [True])
+
+        connection.close()
+        momoko.utils.Poller(connection, ioloop=self.io_loop,
+            errback=calls.append)
+        self.assertEqual(calls, [True])
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertTrue(isinstance(calls[1], psycopg2.InterfaceError))
+
+    def test_warmup(self):
+        """Test that a lazy pool only connects on ``warmup``.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 3,
+            'max_conn': 5,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'lazy': True
+        })
+        self.assertEqual(db.stats.connections, 0)
+        future = db.warmup(callback=self.stop)
+        self.assertEqual(self.wait(), 3)
+        self.assertEqual(future.result(), 3)
+        self.assertEqual(db.stats.connections, 3)
+        db.warmup(2, callback=self.stop)
+        self.assertEqual(self.wait(), 3)
+        db.close()
+
+    def test_fork(self):
+        """Test that a pool starts over with new connections in a forked
+        process.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+        db.execute('SELECT pg_backend_pid();', callback=self.stop)
+        parent = self.wait().fetchone()[0]
+        # Pretend the pool was created by another process
+        db._pool._pid = -1
+        db.execute('SELECT pg_backend_pid();', callback=self.stop)
+        child = self.wait().fetchone()[0]
+        stats = db.stats.as_dict()
+        db.close()
+
+        self.assertNotEqual(child, parent)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['queries'], 1)
+        self.assertEqual([momoko.pools.fork_share(10, 4, task)
+            for task in range(4)], [3, 3, 2, 2])
+
+    def test_fork_while_connecting(self):
+        """Test that a forked child forgets the connections the parent was
+        still opening.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 2,
+            'max_conn': 2,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+        self.assertEqual(db._pool._opening, 2)
+        # Pretend the pool was created by another process
+        db._pool._pid = -1
+        db.execute('SELECT 1;', callback=self.stop)
+        self.assertEqual(self.wait().fetchall(), [(1,)])
+        db.warmup(callback=self.stop)
+        self.assertEqual(self.wait(), 2)
+        # Give the pollers of the inherited connections a chance to run
+        self.io_loop.add_timeout(time.time() + 0.1, self.stop)
+        self.wait()
+
+        self.assertEqual(len(db._pool._pool), 2)
+        self.assertEqual(db._pool._opening, 0)
+        self.assertEqual(db.stats.connections, 2)
+        db.close()
+
+    def test_processes(self):
+        """Test that a pool for forked workers starts when it's used.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 2,
+            'cleanup_timeout': 1,
+            'processes': 1
+        })
+        self.assertEqual(db._pool._ioloop, None)
+        self.assertEqual(db._pool._cleaner, None)
+        self.assertEqual(db._pool._opening, 0)
+
+        db.execute('SELECT 1;', callback=self.stop)
+        self.assertEqual(self.wait().fetchall(), [(1,)])
+        self.assertTrue(db._pool._ioloop is self.io_loop)
+        self.assertNotEqual(db._pool._cleaner, None)
+        db.close()
+
+    def test_per_loop(self):
+        """Test that a client shared by several IOLoops in separate threads
+        uses a pool per IOLoop.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 2,
+            'cleanup_timeout': 0,
+            'per_loop': True
+        })
+        results = {}
+        lock = threading.Lock()
+
+        def worker(index):
+            io_loop = tornado.ioloop.IOLoop()
+            io_loop.make_current()
+
+            def done(cursor):
+                with lock:
+                    results[index] = (cursor.fetchone()[0],
+                        threading.current_thread().name)
+                io_loop.stop()
+
+            db.execute('SELECT %s;', (index,), callback=done)
+            io_loop.start()
+            db._pool.close_shard()
+            io_loop.close(all_fds=False)
+
+        threads = [threading.Thread(target=worker, args=(i,),
+            name='loop-%d' % i) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {0: (0, 'loop-0'), 1: (1, 'loop-1'),
+            2: (2, 'loop-2')})
+        self.assertEqual(db.stats.queries, 3)
+        self.assertEqual(db._pool.shards, {})
+        db.close()
+
+    @unittest.skipIf(asyncio is None, 'asyncio is not available')
+    def test_asyncio(self):
+        """Test a pool on an asyncio event loop.
+        """
+        loop = asyncio.new_event_loop()
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 2,
+            'max_conn': 2,
+            'cleanup_timeout': 0,
+            'lazy': True,
+            'ioloop': loop
+        })
+        try:
+            self.assertEqual(loop.run_until_complete(db.warmup()), 2)
+            future = loop.create_future()
+            db.chain(['SELECT 42;', 'SELECT 43;'], callback=future.set_result)
+            self.assertEqual([cursor.fetchone()[0] for cursor
+                in loop.run_until_complete(future)], [42, 43])
+            future = loop.create_future()
+            db.execute('SELECT pg_sleep(1);', callback=future.set_result,
+                deadline=time.time() + 0.05)
+            self.assertTrue(isinstance(loop.run_until_complete(future),
+                momoko.DeadlineExceeded))
+        finally:
+            db.close()
+            loop.close()
+
+    def test_priority_lanes(self):
+        """Test that interactive queries overtake waiting background queries.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+        order = []
+
+        def done(name, cursor):
+            order.append(name)
+            if len(order) == 6:
+                self.stop()
+
+        for i in range(3):
+            db.execute('SELECT %s;', (i,), priority='background',
+                callback=functools.partial(done, 'background'))
+        for i in range(3):
+            db.execute('SELECT %s;', (i,), priority='interactive',
+                callback=functools.partial(done, 'interactive'))
+        self.wait()
+        db.close()
+
+        self.assertEqual(order[:4].count('interactive'), 3)
+        self.assertEqual(db.stats.lanes['interactive']['checkouts'], 3)
+        self.assertEqual(db.stats.lanes['background']['checkouts'], 3)
+
+    def test_load_shedding(self):
+        """Test that new queries are rejected when the queue is full.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'max_queue': 1,
+            'ioloop': self.io_loop
+        })
+
+        db.execute('SELECT 1;', callback=self.stop)
+        self.assertEqual(db.queue_depth, 1)
+        self.assertRaises(momoko.PoolOverloadError, db.execute, 'SELECT 2;')
+        self.wait()
+
+        # The second query of the chain is rejected in the callback of the
+        # first one, while another query waits
+        db.chain(('SELECT 1;', 'SELECT 2;'), callback=self.stop)
+        db.execute('SELECT 3;')
+        self.assertTrue(isinstance(self.wait(), momoko.PoolOverloadError))
+
+        # A batch that doesn't fit is cancelled as a whole
+        db.batch({'a': 'SELECT 1;', 'b': 'SELECT 2;', 'c': 'SELECT 3;'},
+            callback=self.stop)
+        self.assertTrue(isinstance(self.wait(), momoko.PoolOverloadError))
+        self.assertEqual(db.queue_depth, 0)
+        db.execute('SELECT 4;', callback=self.stop)
+        self.assertEqual(self.wait().fetchall(), [(4,)])
+        db.close()
+
+        self.assertEqual(db.stats.rejections, 3)
+
+    def test_connection(self):
+        """Test running a query on a given connection of the pool.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 2,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+        db.warmup(callback=self.stop)
+        self.wait()
+        pool = db._pool
+        connection = pool._free[0]
+        results = {}
+
+        def done(name, cursor):
+            results[name] = cursor.fetchone()[0]
+            if len(results) == 2:
+                self.stop()
+
+        pool.new_cursor('execute', ('SELECT pg_backend_pid() '
+            'FROM pg_sleep(0.1);', ()), functools.partial(done, 'given'),
+            connection=connection)
+        self.assertRaises(momoko.PoolError, pool.new_cursor, 'execute',
+            ('SELECT 1;', ()), connection=connection)
+        db.execute('SELECT pg_backend_pid();',
+            callback=functools.partial(done, 'other'))
+        self.wait()
+        db.close()
+
+        self.assertNotEqual(results['given'], results['other'])
+
+    def test_cancel(self):
+        """Test cancelling a running and a waiting query.
+        """
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+        results = []
+
+        running = db.execute('SELECT pg_sleep(10);', callback=results.append)
+        waiting = db.execute('SELECT 1;', callback=results.append)
+        waiting.cancel()
+        self.io_loop.add_timeout(time.time() + 0.1, running.cancel)
+        self.io_loop.add_timeout(time.time() + 0.2, lambda: db.execute(
+            'SELECT 42;', callback=self.stop))
+        cursor = self.wait(timeout=2)
+
+        self.assertEqual(cursor.fetchall(), [(42,)])
+        db.close()
+        self.assertEqual(results, [])
+        self.assertEqual(db.stats.cancellations, 2)
+
+    def test_cancel_chain(self):
+        """Test cancelling a chain query.
+        """
+        results = []
+        chain = self.db.chain(('SELECT pg_sleep(10);', 'SELECT 1;'),
+            callback=results.append)
+        self.io_loop.add_timeout(time.time() + 0.1, chain.cancel)
+        self.io_loop.add_timeout(time.time() + 0.2, lambda: self.db.execute(
+            'SELECT 42;', callback=self.stop))
+        self.wait(timeout=2)
+
+        self.assertEqual(results, [])
+
+    def test_deadline(self):
+        """Test a query with a deadline.
+        """
+        self.db.execute('SELECT pg_sleep(10);', callback=self.stop,
+            deadline=time.time() + 0.1)
+        self.assertTrue(isinstance(self.wait(timeout=2),
+            momoko.DeadlineExceeded))
+
+        # The statement_timeout is only set for the query itself
+        self.db.execute('SELECT 1;', callback=self.stop,
+            deadline=time.time() + 1)
+        self.assertEqual(self.wait().fetchall(), [(1,)])
+        self.db.execute('SHOW statement_timeout;', callback=self.stop)
+        self.assertEqual(self.wait().fetchall(), [('0',)])
+
+        # Composed queries and statements that can't run in a transaction
+        # block get the deadline and settings too
+        query = psycopg2.sql.SQL('SELECT {}, current_setting({});').format(
+            psycopg2.sql.Literal(1), psycopg2.sql.Literal('search_path'))
+        self.db.execute(query, callback=self.stop, deadline=time.time() + 1,
+            session={'search_path': 'pg_catalog'})
+        self.assertEqual(self.wait().fetchall(), [(1, 'pg_catalog')])
+        self.db.execute('VACUUM pg_am;', callback=self.stop,
+            deadline=time.time() + 5, session={'search_path': 'public'})
+        self.assertEqual(self.wait().statusmessage, 'VACUUM')
+
+    def test_failed_chain(self):
+        """Test that a chain stops at a query that fails.
+        """
+        self.db.chain(('SELECT 1;', 'SELECT * FROM does_not_exist;',
+            'SELECT 2;'), callback=self.stop)
+        self.assertTrue(isinstance(self.wait(), psycopg2.ProgrammingError))
+
+    def test_deadline_chain(self):
+        """Test a chain query that runs out of time.
+        """
+        results = []
+        self.db.chain(('SELECT 1;', 'SELECT pg_sleep(10);', 'SELECT 2;'),
+            callback=results.append, deadline=time.time() + 0.1)
+        self.io_loop.add_timeout(time.time() + 0.3, self.stop)
+        self.wait(timeout=2)
+
+        self.assertEqual(len(results), 1)
+        self.assertTrue(isinstance(results[0], momoko.DeadlineExceeded))
+
+    def test_process_decoder(self):
+        """Test decoding the rows of a query on a process pool.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(2)
+        chunks = []
+        decoder = ProcessDecoder(executor, chunk_size=10,
+            chunk_callback=chunks.append, ioloop=self.io_loop)
+
+        self.db.execute('SELECT i, i::numeric / 2, DATE \'2012-01-01\' '
+            'FROM generate_series(1, 25) AS i;',
+            callback=self.stop, decoder=decoder)
+        count = self.wait()
+        executor.shutdown()
+
+        self.assertEqual(count, 25)
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual(chunks[0][0],
+            (1, Decimal('0.5'), datetime.date(2012, 1, 1)))
+
+    def test_columnar_cursor(self):
+        """Test fetching a result column by column.
+        """
+        self.db.execute('SELECT i AS id, i * 0.5::float8 AS half, '
+            'NULLIF(i, 2) AS maybe, i::text AS label '
+            'FROM generate_series(1, 3) AS i;',
+            args={'cursor_factory': ColumnarCursor}, callback=self.stop)
+        columns = self.wait().fetchcolumns(use_numpy=False)
+
+        self.assertEqual(list(columns.keys()), ['id', 'half', 'maybe', 'label'])
+        self.assertEqual(columns['id'], array.array('i', [1, 2, 3]))
+        self.assertEqual(columns['half'], array.array('d', [0.5, 1.0, 1.5]))
+        self.assertEqual(columns['maybe'], [1, None, 3])
+        self.assertEqual(columns['label'], ['1', '2', '3'])
+
+    def test_record_cursor(self):
+        """Test fetching compact records with lazily decoded columns.
+        """
+        self.db.execute('SELECT i AS id, i * 1.5 AS price '
+            'FROM generate_series(1, 2) AS i;',
+            args={'cursor_factory': RecordCursor}, callback=self.stop)
+        first, second = self.wait().fetchall()
+
+        self.assertTrue(type(first) is type(second))
+        self.assertEqual(first.id, 1)
+        self.assertEqual(first['price'], Decimal('1.5'))
+        self.assertEqual(second, (2, Decimal('3.0')))
+        self.assertEqual(list(second._asdict().keys()), ['id', 'price'])
+        self.assertEqual(second[0:1], (2,))
+        self.assertEqual(second[::-1], (Decimal('3.0'), 2))
+        self.assertEqual(second[long(-1)], Decimal('3.0'))
+        self.assertFalse(first == None)
+        self.assertTrue(first != None)
+        self.assertNotEqual(first, second)
+
+        # The record class keeps its lazy typecasters
+        casters = type(first)._casters
+        self.assertEqual(len(casters), 2)
+        self.assertTrue(casters[1] is not None)
+
 
 if __name__ == '__main__':
     unittest.main()
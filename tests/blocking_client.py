@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import threading
 import unittest
+import subprocess
 
 import momoko
 import settings
@@ -23,6 +27,7 @@ class BlockingClientTest(unittest.TestCase):
         })
 
     def tearDown(self):
+        self.db.close()
         super(BlockingClientTest, self).tearDown()
 
     def test_single_query(self):
@@ -34,6 +39,130 @@ class BlockingClientTest(unittest.TestCase):
 
         self.assertEqual(cursor.fetchall(), [(42, 12, 40, 11)])
 
+    def test_concurrent_checkout(self):
+        """Test that threads never share a connection.
+        """
+        in_use = set()
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                for i in range(10):
+                    with self.db.connection as conn:
+                        with lock:
+                            self.assertFalse(id(conn) in in_use)
+                            in_use.add(id(conn))
+                        cursor = conn.cursor()
+                        cursor.execute('SELECT pg_sleep(0.01), %s;', (i,))
+                        self.assertEqual(cursor.fetchone()[1], i)
+                        with lock:
+                            in_use.remove(id(conn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker)
+            for i in range(settings.max_conn * 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_warmup(self):
+        """Test that a lazy pool only connects on ``warmup``.
+        """
+        db = momoko.BlockingClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 3,
+            'max_conn': 5,
+            'cleanup_timeout': 0,
+            'lazy': True
+        })
+        self.assertEqual(db.stats.connections, 0)
+        self.assertEqual(db.warmup(), 3)
+        self.assertEqual(db.warmup(4), 4)
+        self.assertEqual(db.stats.connections, 4)
+        db.close()
+
+    def test_close_in_use(self):
+        """Test that a connection that's returned after the pool was closed is
+        counted as returned.
+        """
+        db = momoko.BlockingClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 2,
+            'cleanup_timeout': 0
+        })
+        conn = db._pool.get_connection()
+        self.assertEqual(db.stats.in_use, 1)
+        db.close()
+        self.assertTrue(conn.closed)
+        db._pool.put_connection(conn)
+        self.assertEqual(db.stats.in_use, 0)
+        self.assertEqual(db.stats.connections, 0)
+        db._pool.put_connection(conn)
+        self.assertEqual(db.stats.in_use, 0)
+
+    def test_fork(self):
+        """Test that a forked child gets its own connections and doesn't end
+        the sessions of the parent.
+        """
+        def backend_pid():
+            with self.db.connection as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT pg_backend_pid();')
+                return cursor.fetchone()[0]
+
+        parent = backend_pid()
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(writer, str(backend_pid()).encode('ascii'))
+            finally:
+                os._exit(0)
+        os.close(writer)
+        child = int(os.read(reader, 32))
+        os.close(reader)
+        os.waitpid(pid, 0)
+
+        self.assertNotEqual(child, parent)
+        self.assertEqual(backend_pid(), parent)
+
+    def test_lazy_import(self):
+        """Test that importing the package doesn't import its modules.
+        """
+        package = os.path.dirname(os.path.abspath(momoko.__file__))
+        output = subprocess.check_output([sys.executable, '-c',
+            'import sys, momoko; '
+            'print("momoko.pools" in sys.modules); '
+            'momoko.BlockingClient; '
+            'print("momoko.pools" in sys.modules); '
+            'print(momoko.utils.QueryChain.__name__); '
+            'print(momoko.recorder.__name__); '
+            'print(hasattr(momoko, "nothing"))'],
+            cwd=os.path.dirname(package))
+        self.assertEqual(output.split(), [b'False', b'True', b'QueryChain',
+            b'momoko.recorder', b'False'])
+
+        names = dir(momoko)
+        self.assertTrue('BlockingClient' in names)
+        self.assertTrue('__version__' in names)
+        for name in ('sys', 'ModuleType', 'import_module', '_exports',
+                     '_origins', '_module', '_original'):
+            self.assertFalse(name in names)
+
 
 if __name__ == '__main__':
     unittest.main()
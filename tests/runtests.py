@@ -5,6 +5,7 @@ import unittest
 
 TEST_MODULES = [
     'async_client',
+    'threaded_client',
     'adisp_client',
     'blocking_client'
 ]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import unittest
+
+import tornado.ioloop
+import tornado.testing
+import momoko
+
+import settings
+
+
+class ThreadedClientTest(tornado.testing.AsyncTestCase):
+    """``ThreadedClient`` tests.
+    """
+    def setUp(self):
+        super(ThreadedClientTest, self).setUp()
+        self.stats = momoko.PoolStats()
+        self.db = momoko.ThreadedClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': settings.min_conn,
+            'max_conn': settings.max_conn,
+            'cleanup_timeout': settings.cleanup_timeout,
+            'stats': self.stats,
+            'ioloop': self.io_loop
+        })
+
+    def tearDown(self):
+        self.db.close()
+        super(ThreadedClientTest, self).tearDown()
+
+    def test_single_query(self):
+        """Test executing a single SQL query.
+        """
+        self.db.execute('SELECT 42, 12, 40, 11;', callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.fetchall(), [(42, 12, 40, 11)])
+        self.assertEqual(self.stats.queries, 1)
+
+    def test_fetched_cursor(self):
+        """Test that the rows are fetched on the worker thread, before the
+        connection goes back to the pool.
+        """
+        self.db.execute('SELECT generate_series(1, 5);',
+            args={'name': 'server_side'}, callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.rowcount, 5)
+        self.assertEqual(cursor.description[0].name, 'generate_series')
+        self.assertEqual(cursor.fetchone(), (1,))
+        self.assertEqual(cursor.fetchmany(2), [(2,), (3,)])
+        self.assertEqual(list(cursor), [(4,), (5,)])
+
+        self.db.execute('CREATE TEMPORARY TABLE fetched (id integer);',
+            callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.statusmessage, 'CREATE TABLE')
+        self.assertEqual(cursor.fetchall(), [])
+
+        self.db.execute('SELECT 1 FROM pg_class WHERE false;',
+            callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.rowcount, 0)
+        self.assertEqual(cursor.fetchone(), None)
+
+    def test_run(self):
+        """Test running a function with a connection on a worker thread.
+        """
+        def work(conn, value):
+            cursor = conn.cursor()
+            cursor.execute('SELECT %s;', (value,))
+            return cursor.fetchone()[0] * 2
+
+        self.db.run(work, 21, callback=self.stop)
+        self.assertEqual(self.wait(), 42)
+
+    def test_error(self):
+        """Test that errors are passed on to the callback.
+        """
+        self.db.execute('SELECT * FROM does_not_exist;', callback=self.stop)
+        self.assertTrue(isinstance(self.wait(), Exception))
+
+
+if __name__ == '__main__':
+    unittest.main()